@@ -0,0 +1,23 @@
+'''
+Writes a file so that a crash leaves either the old or the new content at its path, never a half written file or
+none at all.
+
+  atomic_write('latency_history.json', json.dumps(history))
+'''
+
+import os
+
+
+def atomic_write(path, data):
+    '''Writes data to a temporary file next to path and renames it over path'''
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as fl:
+        fl.write(data)
+        fl.flush()
+        os.fsync(fl.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        # Windows doesn't rename over an existing file, the old content is lost if the process dies right here
+        os.remove(path)
+    # Replaces path in one step on POSIX
+    os.rename(temp_path, path)
@@ -0,0 +1,512 @@
+'''
+What:
+  Measures the overhead of the drive harness itself, without a Sparrow binary or live sites.
+  A fake webdriver remote stands in for Sparrow: it emulates sparrow://beerstatus with a configurable ack delay,
+  tab crashes and page load timeouts, and loads pages from a local HTTP server serving this repo's own pages.
+  Reports sites/sec and where the time goes (webdriver calls, sleeps, the harness itself) for
+  SparrowDriver.visit_sites and selenium_methods.runSelenium.
+
+How:
+  Needs the same libraries as drive.py, but no chromedriver or Sparrow.
+
+  Usage: python benchmark.py [--sites 50] [--ack-delay 0.2] [--crash-rate 0.01] [--timeout-rate 0.01]
+                             [--round-trip 0.002] [--config extra_config.json] [--only visit_sites]
+'''
+
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import re
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import uuid
+import zlib
+from collections import defaultdict
+
+from selenium.common.exceptions import TimeoutException, WebDriverException, NoSuchElementException
+from selenium.webdriver.remote.command import Command
+
+import selenium_methods
+import drive
+from local_server import StaticServer
+from remote_pool import RemotePool
+from results_store import ResultsStore
+
+# The fake remote's own waiting is webdriver time, not a harness sleep
+real_sleep = time.sleep
+
+# Pages of this repo used as the sitelist
+BENCHMARK_PAGES = ['latency_test.html', 'one_image.html', 'just_a_css.html', 'multiple_files.html', 'index.html']
+
+
+def fake_png(seed, size=64):
+    '''A valid greyscale PNG with a pattern that depends on seed, standing in for a screenshot'''
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    rows = ''.join('\0' + ''.join(chr((x * y + seed) % 256) for x in range(size)) for y in range(size))
+    return ('\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', size, size, 8, 0, 0, 0, 0)) +
+            chunk('IDAT', zlib.compress(rows)) + chunk('IEND', ''))
+
+
+class Timings(object):
+    '''Time spent per phase, shared by everything one benchmark run measures'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        # (start, end) of every drive session, they run in parallel with concurrency
+        self.sessions = []
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.seconds[phase] += seconds
+            self.calls[phase] += 1
+
+    def add_session(self, start_time, end_time):
+        with self.lock:
+            self.sessions.append((start_time, end_time))
+
+    def thread_time(self, elapsed):
+        '''elapsed with the time sessions ran in parallel counted once per session, as phases add up their threads'''
+
+        if len(self.sessions) < 2:
+            return elapsed
+        span = max(end for start, end in self.sessions) - min(start for start, end in self.sessions)
+        return elapsed - span + sum(end - start for start, end in self.sessions)
+
+
+class FakeElement(object):
+
+    def __init__(self, remote, element_id, text='', properties=None):
+        self.parent = remote
+        self.id = element_id
+        self.text = text
+        self.properties = properties or {}
+
+    def get_property(self, name):
+        return self.properties.get(name)
+
+
+class FakeCommandExecutor(object):
+
+    def __init__(self):
+        self._commands = {}
+
+
+class FakeRemote(object):
+    '''
+    Implements the part of the webdriver API the harness uses.
+    Every call costs round_trip seconds, like a webdriver HTTP request to a local chromedriver.
+    '''
+
+    w3c = False
+
+    # Settings for newly created remotes, set by the benchmark
+    settings = {'ack_delay': 0.2, 'crash_rate': 0.0, 'timeout_rate': 0.0, 'round_trip': 0.002}
+    timings = None
+
+    def __init__(self, command_executor=None, desired_capabilities=None):
+        self.capabilities = desired_capabilities or {}
+        self.settings = dict(FakeRemote.settings)
+        self.timings = FakeRemote.timings or Timings()
+        self.random = random.Random()
+        self.tabs = {'tab-0': 'about:blank'}
+        self.current = 'tab-0'
+        self.page_source = {}
+        self.pending_link = None
+        # Console log and performance log entries not read yet
+        self.console = []
+        self.network = []
+        # Entries of the emulated sparrow://beerstatus table: (time the entry shows up, entry)
+        self.beers = []
+        self.alive = True
+        self.command_executor = FakeCommandExecutor()
+        self.network_conditions = None
+        self.call('new_session')
+
+    def call(self, phase, seconds=None):
+        if not self.alive:
+            raise WebDriverException('invalid session id')
+        start_time = time.time()
+        real_sleep(self.settings['round_trip'] if seconds is None else seconds)
+        self.timings.add('remote.' + phase, time.time() - start_time)
+
+    @property
+    def window_handles(self):
+        self.call('window_handles')
+        return sorted(self.tabs)
+
+    def switch_to_window(self, handle):
+        self.call('switch_to_window')
+        if handle not in self.tabs:
+            raise WebDriverException('no such window')
+        self.current = handle
+
+    def close(self):
+        self.call('close')
+        del self.tabs[self.current]
+
+    def quit(self):
+        self.call('quit')
+        self.alive = False
+
+    def set_script_timeout(self, seconds):
+        self.call('set_timeout')
+
+    def set_page_load_timeout(self, seconds):
+        self.call('set_timeout')
+
+    def get(self, url):
+        self.call('get')
+        self.navigate(url)
+
+    def refresh(self):
+        self.get(self.tabs[self.current])
+
+    def navigate(self, url):
+        self.tabs[self.current] = url
+        self.page_source[self.current] = ''
+        if url.startswith('data:'):
+            self.page_source[self.current] = urllib.unquote(url.split(',', 1)[1])
+            self.find_link()
+            return
+        if not url.startswith('http'):
+            return
+
+        if self.random.random() < self.settings['crash_rate']:
+            self.alive = False
+            raise WebDriverException('session deleted because of page crash')
+        if self.random.random() < self.settings['timeout_rate']:
+            raise TimeoutException('timeout: Timed out receiving message from renderer')
+
+        start_time = time.time()
+        self.page_source[self.current] = urllib2.urlopen(url).read()
+        self.timings.add('page load', time.time() - start_time)
+        self.console.append({'level': 'INFO', 'message': '%s loaded' % url, 'source': 'console-api',
+                             'timestamp': int(time.time() * 1000)})
+        self.add_network_events(url, start_time, time.time())
+
+        if '/hyperlink_template.html' in url:
+            self.find_link()
+        else:
+            self.beers.append((time.time() + self.settings['ack_delay'],
+                               {'BEER for url': url, 'GUID': str(uuid.uuid4()), 'Acked': '1'}))
+
+    def find_link(self):
+        # Template pages served with the link already in place
+        match = re.search(r'<a href="(.*?)">', self.page_source[self.current])
+        if match:
+            self.pending_link = match.group(1).replace('&amp;', '&')
+
+    def execute(self, command, params=None):
+        self.call('execute')
+        if command == Command.CLICK and self.pending_link:
+            self.navigate(self.pending_link)
+        elif command in self.command_executor._commands:
+            self.network_conditions = params['network_conditions']
+        return {'value': None}
+
+    def find_element_by_id(self, element_id):
+        self.call('find_element')
+        if element_id == 'speed-value':
+            return FakeElement(self, element_id, text='42')
+        return FakeElement(self, element_id)
+
+    def find_element_by_link_text(self, text):
+        self.call('find_element')
+        if not self.pending_link:
+            raise NoSuchElementException('no such element: %s' % text)
+        return FakeElement(self, 'link')
+
+    def find_element_by_tag_name(self, name):
+        self.call('find_element')
+        match = re.search(r'<title>(.*?)</title>', self.page_source.get(self.current, ''), re.S)
+        if not match:
+            raise NoSuchElementException('no such element: %s' % name)
+        return FakeElement(self, name, properties={'text': match.group(1).strip()})
+
+    def get_screenshot_as_png(self):
+        self.call('screenshot')
+        return fake_png(hash(self.page_source.get(self.current, '')))
+
+    def get_screenshot_as_base64(self):
+        return base64.b64encode(self.get_screenshot_as_png())
+
+    def save_screenshot(self, path):
+        with open(path, 'wb') as fl:
+            fl.write(self.get_screenshot_as_png())
+        return True
+
+    def beer_entries(self):
+        now = time.time()
+        return [entry for shows_up, entry in self.beers if shows_up <= now]
+
+    def add_network_events(self, url, start_time, end_time):
+        request_id = str(len(self.network))
+        timing = {'requestTime': start_time, 'dnsStart': -1, 'dnsEnd': -1, 'connectStart': 0.1, 'connectEnd': 0.3,
+                  'sslStart': -1, 'sslEnd': -1, 'sendStart': 0.4, 'sendEnd': 0.5, 'receiveHeadersEnd': 1.0}
+        events = [('Network.requestWillBeSent', {'request': {'url': url, 'method': 'GET', 'headers': {}},
+                                                 'wallTime': start_time, 'timestamp': start_time,
+                                                 'initiator': {'type': 'other'}, 'type': 'Document'}),
+                  ('Network.responseReceived', {'response': {'status': 200, 'mimeType': 'text/html', 'timing': timing,
+                                                             'connectionReused': False, 'connectionId': 1}}),
+                  ('Network.loadingFinished', {'timestamp': end_time, 'encodedDataLength': 1000})]
+        for method, params in events:
+            params['requestId'] = request_id
+            self.network.append({'level': 'INFO', 'timestamp': int(time.time() * 1000),
+                                 'message': json.dumps({'message': {'method': method, 'params': params}})})
+
+    def get_log(self, log_type):
+        self.call('get_log')
+        if log_type == 'performance':
+            entries, self.network = self.network, []
+        else:
+            entries, self.console = self.console, []
+        return entries
+
+    def execute_script(self, script, *args):
+        self.call('execute_script')
+        if script == selenium_methods.READ_BEER_STATUS_SCRIPT:
+            return self.beer_entries()
+        if 'window.open' in script:
+            self.tabs['tab-%s' % len(self.tabs)] = 'about:blank'
+            return None
+        match = re.search(r'href=\\?"(.*?)\\?"', script)
+        if match:
+            self.pending_link = match.group(1)
+        return None
+
+    def execute_async_script(self, script, *args):
+        if script == selenium_methods.WAIT_FOR_BEER_ACK_SCRIPT:
+            url, last_guid, window_ms = args
+            deadline = time.time() + window_ms / 1000.0
+            upcoming = [shows_up for shows_up, entry in self.beers
+                        if entry['BEER for url'] == url and entry['GUID'] != last_guid]
+            shows_up = min(upcoming) if upcoming else None
+            if shows_up is None or shows_up > deadline:
+                self.call('execute_async_script', max(deadline - time.time(), 0))
+                return None
+            self.call('execute_async_script', max(shows_up - time.time(), 0) + self.settings['round_trip'])
+            return [entry for entry in self.beer_entries() if entry['BEER for url'] == url][-1]
+
+        self.call('execute_async_script')
+        if script == selenium_methods.NAVIGATION_TIMING_SCRIPT:
+            return {'url': self.tabs[self.current], 'navigation': {'startTime': 0, 'loadEventEnd': 1.0}, 'paint': {}}
+        return None
+
+
+class FakeSparrowController(object):
+    '''Stands in for the sparrow controller of a cpe used by runSelenium'''
+
+    def __init__(self, user_data_dir):
+        self.user_data_dir = user_data_dir
+
+    def stopSparrow(self):
+        pass
+
+    def removeLeftoverBBs(self):
+        pass
+
+    def startWebdriver(self, exe_loc, whitelist_ip):
+        return True
+
+    def stopWebdriver(self):
+        pass
+
+    def getSparrowFullPath(self, op_sys):
+        return '/bin/true'
+
+    def getSparrowUserDataWarmPath(self, op_sys):
+        return self.user_data_dir
+
+    def removeDir(self, dir_path):
+        return True
+
+
+class Context(object):
+    pass
+
+
+class BenchmarkSparrowDriver(drive.SparrowDriver):
+    '''SparrowDriver reading its config from a dict, with a made up Sparrow binary'''
+
+    def __init__(self, json_data):
+        fd, self.json_config_file = tempfile.mkstemp(suffix='.json')
+        with os.fdopen(fd, 'w') as fl:
+            json.dump(json_data, fl)
+        super(BenchmarkSparrowDriver, self).__init__()
+        os.remove(self.json_config_file)
+
+    def get_command_line(self):
+        self.username = 'benchmark'
+
+    def detect_binary(self, json_data):
+        self.binary_location = '/bin/true'
+        self.chromium_version = 'benchmark'
+        self.user_agent = drive.USR_AGENT_OSX % self.chromium_version
+
+    def visit_session_sites(self, *args, **kwargs):
+        start_time = time.time()
+        try:
+            super(BenchmarkSparrowDriver, self).visit_session_sites(*args, **kwargs)
+        finally:
+            FakeRemote.timings.add_session(start_time, time.time())
+
+
+class Patches(object):
+    '''Replaces webdriver, sleeps and process handling for the duration of a benchmark'''
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.originals = []
+
+    def patch(self, owner, name, value):
+        self.originals.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+    def __enter__(self):
+        timings = self.timings
+
+        def sleep(seconds):
+            start_time = time.time()
+            real_sleep(seconds)
+            # Not the polling of the ThreadPool running parallel sessions, which isn't drive's time
+            if not sys._getframe(1).f_globals.get('__name__', '').startswith('multiprocessing'):
+                timings.add('sleep', time.time() - start_time)
+
+        FakeRemote.timings = timings
+        self.patch(time, 'sleep', sleep)
+        self.patch(selenium_methods.webdriver, 'Remote', FakeRemote)
+        self.patch(selenium_methods, 'stop_sparrow', lambda *args: None)
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, name, value in reversed(self.originals):
+            setattr(owner, name, value)
+        FakeRemote.timings = None
+
+
+def write_sitelist(server, num_sites):
+    fd, path = tempfile.mkstemp(suffix='.txt')
+    with os.fdopen(fd, 'w') as fl:
+        for i in range(num_sites):
+            fl.write(server.url(BENCHMARK_PAGES[i % len(BENCHMARK_PAGES)]) + '?site=%s\n' % i)
+    return path
+
+
+def bench_visit_sites(sitelist, extra_config):
+    json_data = {'sitelist_file': sitelist, 'log_file': os.devnull, 'test_label_prefix': 'benchmark',
+                 'percent_clicks_on_hover': 100, 'results_file': os.devnull}
+    json_data.update(extra_config)
+
+    sdrv = BenchmarkSparrowDriver(json_data)
+
+    sdrv.remote_pool = RemotePool('http://127.0.0.1:0', standby=sdrv.warm_standby)
+    sdrv.results_store = ResultsStore(os.devnull)
+    sdrv.stats['total'] = 0
+
+    if sdrv.schedule == 'sequential':
+        sdrv.visit_sites_paired('cold')
+    else:
+        sdrv.visit_sites(False, 'cold')
+    sdrv.remote_pool.close()
+    sdrv.results_store.close()
+    if sdrv.screenshots is not None:
+        sdrv.screenshots.close()
+    for store in (sdrv.browser_log_store, sdrv.network_capture_store):
+        if store is not None:
+            store.close()
+    return sdrv.stats.get('sites', 0)
+
+
+def bench_run_selenium(sitelist, extra_config):
+    context = Context()
+    context.common = Context()
+    context.common.jenkinsIp = '127.0.0.1'
+    context.urlListFile = sitelist
+    context.listIterations = 1
+
+    controller = FakeSparrowController(tempfile.mkdtemp())
+    selenium_methods.runSelenium(context=context, browser_name='benchmark',
+                                 browser_dict={'controller': controller, 'ip': '127.0.0.1'},
+                                 cpeLocation='http://127.0.0.1:0', cmdSwitches=[], op_sys='mac',
+                                 cache_state='cold', hover=True)
+    return len([site for site in context.sitelist if site])
+
+
+BENCHMARKS = [('visit_sites', bench_visit_sites), ('runSelenium', bench_run_selenium)]
+
+
+def print_report(name, sites, elapsed, timings):
+    print("\n%s: %s sites in %.2fs, %.2f sites/sec" % (name, sites, elapsed, sites / elapsed if elapsed else 0))
+
+    # Phases are summed over the threads of parallel sessions, so they are shares of the time of all threads
+    total = timings.thread_time(elapsed)
+    if len(timings.sessions) > 1:
+        print("  %s parallel sessions, %.2fs of thread time" % (len(timings.sessions), total))
+
+    accounted = 0
+    for phase in sorted(timings.seconds, key=lambda phase: -timings.seconds[phase]):
+        seconds = timings.seconds[phase]
+        if phase != 'page load':
+            accounted += seconds
+        print("  %-32s %8.3fs %6.1f%% %7d calls %8.2fms/site" % (phase, seconds, 100 * seconds / total,
+                                                                  timings.calls[phase], 1000 * seconds / max(sites, 1)))
+
+    # Page loads happen inside remote.get and remote.execute, the rest is the harness itself
+    harness = total - accounted
+    print("  %-32s %8.3fs %6.1f%% %7s       %8.2fms/site" % ('harness', harness, 100 * harness / total, '',
+                                                             1000 * harness / max(sites, 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sites', type=int, default=50, help='number of sites in the benchmark sitelist')
+    parser.add_argument('--ack-delay', type=float, default=0.2, help='seconds until a beer shows up as acked')
+    parser.add_argument('--crash-rate', type=float, default=0.0, help='fraction of page loads crashing the tab')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='fraction of page loads timing out')
+    parser.add_argument('--round-trip', type=float, default=0.002, help='seconds per webdriver call')
+    parser.add_argument('--config', help='json file with config values for visit_sites, e.g. ack_wait_mode')
+    parser.add_argument('--only', choices=[name for name, benchmark in BENCHMARKS], help='run a single benchmark')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    extra_config = {}
+    if args.config:
+        with open(args.config) as fl:
+            extra_config = json.load(fl)
+
+    FakeRemote.settings = {'ack_delay': args.ack_delay, 'crash_rate': args.crash_rate,
+                           'timeout_rate': args.timeout_rate, 'round_trip': args.round_trip}
+
+    server = StaticServer().start()
+    selenium_methods.HYPERLINK_TEMPLATE_URL = server.url('sitelists/hyperlink_template.html')
+    sitelist = write_sitelist(server, args.sites)
+    try:
+        for name, benchmark in BENCHMARKS:
+            if args.only and name != args.only:
+                continue
+            timings = Timings()
+            with Patches(timings):
+                start_time = time.time()
+                sites = benchmark(sitelist, extra_config)
+                elapsed = time.time() - start_time
+            print_report(name, sites, elapsed, timings)
+    finally:
+        os.remove(sitelist)
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
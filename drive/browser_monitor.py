@@ -0,0 +1,80 @@
+'''
+Samples the CPU and memory use of the browser process trees started by chromedriver.
+
+  monitor = BrowserMonitor(service.process.pid)
+  record['browser'] = monitor.sample(user_data_dir)
+
+Each session's browser is the descendant of chromedriver launched with its --user-data-dir, its tree is the browser
+and all the processes under it (renderers, gpu, utility). cpu_percent is summed over the tree since the last sample of
+the same process, so it can go over 100 on several cores. One monitor can be shared by the threads of all sessions.
+'''
+
+import logging
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+class BrowserMonitor(object):
+
+    def __init__(self, root_pid):
+        self.root = psutil.Process(root_pid)
+        # user-data-dir -> browser process
+        self.browsers = {}
+        # pid -> Process, kept so that cpu_percent measures from the previous sample
+        self.processes = {}
+        self.lock = threading.Lock()
+
+    def find_browser(self, user_data_dir):
+        browser = self.browsers.get(user_data_dir)
+        if browser is not None and browser.is_running():
+            return browser
+
+        argument = '--user-data-dir=%s' % user_data_dir
+        for process in self.root.children(recursive=True):
+            try:
+                if argument in process.cmdline() and argument not in process.parent().cmdline():
+                    self.browsers[user_data_dir] = process
+                    return process
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return None
+
+    def sample(self, user_data_dir):
+        '''Returns {'rss_mb', 'cpu_percent', 'processes'} of the browser tree of user_data_dir, None if not running'''
+
+        with self.lock:
+            return self.sample_locked(user_data_dir)
+
+    def sample_locked(self, user_data_dir):
+        try:
+            browser = self.find_browser(user_data_dir)
+            if browser is None:
+                return None
+            tree = [browser] + browser.children(recursive=True)
+        except psutil.Error as e:
+            logging.debug("Unable to list browser processes: %s" % e)
+            return None
+
+        rss = 0
+        cpu_percent = 0.0
+        alive = 0
+        for process in tree:
+            # The same Process object each time, its first cpu_percent is 0 and later ones cover the interval since
+            process = self.processes.setdefault(process.pid, process)
+            try:
+                rss += process.memory_info().rss
+                cpu_percent += process.cpu_percent(None)
+                alive += 1
+            except psutil.Error:
+                self.processes.pop(process.pid, None)
+
+        pids = set(process.pid for process in tree)
+        for pid in list(self.processes):
+            if pid not in pids and not self.processes[pid].is_running():
+                del self.processes[pid]
+
+        return {'rss_mb': rss / 1048576.0, 'cpu_percent': cpu_percent, 'processes': alive}
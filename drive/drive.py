@@ -6,6 +6,7 @@ What:
 How:
   You will need to "pip install -r requirements.txt"
   Put Chromedriver (https://sites.google.com/a/chromium.org/chromedriver/downloads) on your PATH
+  On a Linux server without a display set "headless": true, or "virtual_display": true to run in Xvfb
 
   You will want to run from a directory that includes:
      1) selenium_methods.py file found in git at IHS/automation/lift_acceptance_tests/steps
@@ -18,6 +19,8 @@ How:
 
   Usage: python drive.py -c config.json
 
+  To compare sparrow and chromiumlike from the results files: python drive.py report drive_results.jsonl
+
   Or, to use a remote config file, then pass the following config.json at the command line
 
   config.json ex:
@@ -28,7 +31,6 @@ How:
 '''
 
 import time
-import urllib2
 import datetime
 import os, sys, shutil
 from selenium import webdriver
@@ -38,10 +40,19 @@ from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import NoSuchElementException, WebDriverException
 from selenium.webdriver.common.action_chains import ActionChains
 import argparse
+import atexit
 import logging
 import json
+import math
 import random
+import re
 import subprocess
+from distutils.spawn import find_executable
+from multiprocessing.dummy import Pool as ThreadPool
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 try:
     import selenium_methods
@@ -52,11 +63,116 @@ except:
     sys.path.append(path)
     from lift_acceptance_tests.steps import selenium_methods
 
+from remote_pool import RemotePool
+from profile_snapshot import ProfileSnapshots
+from results_store import ResultsStore, CompressedStore
+from spans import Tracer, HistogramExporter, EXPORTERS
+from remote_cache import RemoteCache
+from local_server import HoverTemplateServer, DataTemplate
+from latency_model import LatencyModel
+from sequential_test import PairedSequentialTest
+from screenshot_store import ScreenshotStore
+from waits import wait_until, profile_unlocked
+from link_probe import LinkProbe, NULL_LOADING
+import har
+from browser_monitor import BrowserMonitor
+from remote_pool import user_data_dir_of
+from replay_proxy import ReplayProxy, MODES as REPLAY_MODES
+from hint_service import HintService, DEFAULT_HINT_FILES
+
 USR_AGENT_OSX = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%s Safari/537.36"
 USR_AGENT_WIN = "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%s Safari/537.36"
-USR_AGENT_LINUX = "??"
+USR_AGENT_LINUX = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/%s Safari/537.36"
 WINDOWS_SPARROW_LOCATION = 'C:\\Users\\%s\\AppData\\Local\\ViaSat\\Sparrow\\Application\\sparrow.exe'
 MAC_SPARROW_LOCATION = '/Applications/Sparrow.app/Contents/MacOS/Sparrow'
+# Searched in order when sparrow_location_linux is not set, then the PATH
+LINUX_SPARROW_LOCATIONS = ['/opt/viasat/sparrow/sparrow', '/opt/sparrow/sparrow', '/usr/bin/sparrow']
+
+# Screen of the Xvfb server started with virtual_display
+VIRTUAL_DISPLAY_SCREEN = '1920x1080x24'
+
+# Stats that describe the last site visited rather than count events, these are not summed across sessions
+PER_SITE_STATS = ('time', 'browser_load_time', 'waiting_for_ack')
+
+# Seconds to wait for the beer ack of a site
+ACK_TIMEOUT = 40
+
+# Links emulated with network_profile, in addition to the real link. Configs can add their own in network_profiles.
+NETWORK_PROFILES = {
+    'geo-satellite': {'latency_ms': 600, 'download_mbps': 10, 'upload_mbps': 2},
+    'cable': {'latency_ms': 20, 'download_mbps': 100, 'upload_mbps': 10},
+    'dsl': {'latency_ms': 50, 'download_mbps': 8, 'upload_mbps': 1},
+    '3g': {'latency_ms': 300, 'download_mbps': 1.6, 'upload_mbps': 0.75},
+}
+
+# Seconds to wait for a browser to release its profile after it quit
+PROFILE_UNLOCK_TIMEOUT = 10
+
+# Seconds to wait for a page to load, chromedriver's default. With latency_model sites get their own, never longer
+PAGE_LOAD_TIMEOUT = 300
+
+BROWSING_DATA_DIR = 'Default'
+CACHE_DIR = 'Cache'
+CACHE_FILES = ['Cookies', 'Cookies-journal', 'History', 'History-journal']
+
+# Config keys and the SparrowDriver method applying them. On a reload only the methods whose keys changed run again,
+# keys not listed here are applied by apply_settings.
+CONFIG_GROUPS = [
+    (('log_file', 'log_level', 'log_to_console'), 'setup_logging'),
+    (('sparrow_location_mac', 'sparrow_location_windows', 'sparrow_location_linux'), 'detect_binary'),
+    (('sitelist_file', 'poll_download_speed', 'link_probe_url'), 'load_sitelist'),
+    (('alternate_sparrow_chromiumlike', 'chromiumlike_only', 'schedule'), 'set_user_data_dirs'),
+    (('span_exporters',), 'setup_tracer'),
+    (('profile_snapshots', 'profile_snapshot_dir'), 'setup_profile_snapshots'),
+    (('results_file',), 'setup_results_file'),
+    (('save_screenshots', 'screenshot_dir', 'screenshot_max_width', 'screenshot_dedupe'), 'setup_screenshots'),
+    (('hover_template',), 'setup_hover_template'),
+    (('browser_logs', 'browser_log_dir'), 'setup_browser_logs'),
+    (('network_capture', 'network_capture_dir'), 'setup_network_capture'),
+    (('replay_mode', 'replay_archive', 'replay_latency_ms', 'replay_origin_latency_ms'), 'setup_replay_proxy'),
+    (('hint_service', 'hint_files', 'hint_latency_ms', 'hint_ttl', 'hint_service_log'), 'setup_hint_service'),
+    (('link_probe_url', 'link_probe_interval'), 'setup_link_probe'),
+    (('latency_model', 'latency_history_file', 'latency_margin'), 'setup_latency_model'),
+    (('sequential_alpha', 'sequential_tau', 'sequential_max_pairs', 'sequential_metric'), 'setup_sequential_tests'),
+]
+
+# (binary location, mtime) -> chromium version, so that config reloads don't run the binary again
+BINARY_VERSIONS = {}
+
+def binary_version(binary_location, detect):
+    try:
+        mtime = os.path.getmtime(binary_location)
+    except OSError:
+        mtime = None
+
+    key = (binary_location, mtime)
+    if key not in BINARY_VERSIONS:
+        BINARY_VERSIONS[key] = detect()
+    return BINARY_VERSIONS[key]
+
+class DriveSession(object):
+    '''A browser session driven by one thread, and what it has to remember between sites'''
+
+    def __init__(self, chromiumlike, cache_state, driver_options, test_label, restart_sparrow=True):
+        self.chromiumlike = chromiumlike
+        self.mode = "chromiumlike" if chromiumlike else "sparrow"
+        self.cache_state = cache_state
+        self.driver_options = driver_options
+        self.test_label = test_label
+        self.restart_sparrow = restart_sparrow
+        self.remote = None
+        self.beerstatus_tab = None
+        self.content_tab = None
+        # Page load timeout currently set on remote, None for the chromedriver default
+        self.page_load_timeout = None
+        # site -> GUID of its last acked beer
+        self.beer_status = {}
+        # Pass of the drive loop the session belongs to
+        self.pass_number = 0
+
+    def pass_name(self):
+        return '%05d-%s-%s' % (self.pass_number, self.mode, self.cache_state)
+
 
 class SparrowDriver(object):
 
@@ -71,6 +187,10 @@ class SparrowDriver(object):
         with open(self.json_config_file) as fl:
             json_data = json.load(fl)
 
+        # Remote sitelists and config files are kept here and only downloaded again when they changed
+        self.remote_cache = RemoteCache(json_data.get('remote_cache_dir',
+            os.path.join(os.path.dirname(os.path.realpath(__file__)), 'remote_cache')))
+
         # Check for a remote config file
         self.remote_config_file = json_data.get('remote_config_file_location')
         if self.remote_config_file:
@@ -80,13 +200,21 @@ class SparrowDriver(object):
 
         # Read the config file; set attributes
         self.json_config_parser(json_data)
+        self.remote_pool = None
+        self.results_store = None
+        self.browser_monitor = None
+        # Counts the passes over the sitelist, screenshots are saved per pass
+        self.pass_number = 0
+        # Sitelist in latency model order, kept for all passes of a cycle so both modes visit sites in the same order
+        self.cycle_sitelist = None
 
         self.test_start_time = datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')
 
     def load_remote_config(self):
 
         print "Using remote config file at: %s" % self.remote_config_file
-        json_data = json.load(urllib2.urlopen(self.remote_config_file))
+        # Copied, the cached config is reused as long as the remote file does not change
+        json_data = dict(self.remote_cache.fetch_json(self.remote_config_file))
 
         # Check the local config for any override values. test_label_prefix is a good example...
         with open(self.json_config_file) as fl:
@@ -111,6 +239,34 @@ class SparrowDriver(object):
     def json_config_parser(self, json_data):
         '''Parses the config.json file and sets attributes that will eventually be cmd switches and options passed to selenium'''
 
+        for keys, method in CONFIG_GROUPS:
+            getattr(self, method)(json_data)
+        self.apply_settings(json_data)
+
+        self.active_config = json_data
+
+    def reload_config(self, json_data):
+        '''Applies a reloaded config, only re-running the parts of json_config_parser whose keys changed'''
+
+        changed = set(key for key in set(self.active_config) | set(json_data)
+                      if self.active_config.get(key) != json_data.get(key))
+        if changed:
+            logging.info("Config keys changed: %s" % ', '.join(sorted(changed)))
+
+        grouped = set()
+        for keys, method in CONFIG_GROUPS:
+            grouped.update(keys)
+            # A remote sitelist can change without the config changing, the remote cache makes this cheap. So can the
+            # Sparrow binary when it is upgraded in place, binary_version only runs it again if its mtime changed
+            if (changed.intersection(keys) or method == 'detect_binary' or
+                    (method == 'load_sitelist' and self.sitelist_file.lower().startswith('http'))):
+                getattr(self, method)(json_data)
+        if changed - grouped:
+            self.apply_settings(json_data)
+
+        self.active_config = json_data
+
+    def setup_logging(self, json_data):
         logging_file = json_data.get('log_file', 'drive_log')
         log_level = json_data.get('log_level', 'info')
 
@@ -135,41 +291,10 @@ class SparrowDriver(object):
             console.setFormatter(formatter)
             logging.getLogger('').addHandler(console)
 
-        # Discover chromium version and set user agent for use in chromiumlike mode
-        if 'darwin' in sys.platform:
-            self.binary_location = json_data.get('sparrow_location_mac',
-                MAC_SPARROW_LOCATION)
-            p = subprocess.Popen([self.binary_location, '--version'], stdout=subprocess.PIPE)
-            if p is None:
-                logging.info("Unable to open Sparrow at : %s" % self.binary_location)
-                sys.exit(1)
-            out, err = p.communicate()
-            self.chromium_version = out.strip().split()[1]
-            self.user_agent = USR_AGENT_OSX % self.chromium_version
-
-        elif 'win' in sys.platform.lower():
-            self.binary_location = json_data.get('sparrow_location_windows',
-                WINDOWS_SPARROW_LOCATION % self.username)
-
-            if 'cygwin' in sys.platform.lower():
-                cmd = ['wmic', 'datafile', 'where', r'name="%s"' % self.binary_location.replace('\\', '\\\\'), 'get', 'Version']
-                p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            else:
-                cmd = r'wmic datafile where name="%s" get Version' % self.binary_location.replace('\\', '\\\\')
-                p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-            if p is None:
-                logging.info("Unable to open Sparrow at : %s" % self.binary_location)
-                sys.exit(1)
-            out, err = p.communicate()
-            self.chromium_version = out.split()[1]
-            self.user_agent = USR_AGENT_WIN % self.chromium_version
-
-
-        self.percent_clicks_on_hover = json_data.get('percent_clicks_on_hover', 100)
+    def load_sitelist(self, json_data):
         self.sitelist_file = json_data.get('sitelist_file')
         if self.sitelist_file.lower().startswith('http'):
-            self.sitelist = urllib2.urlopen(self.sitelist_file).read().split("\n")
+            self.sitelist = self.remote_cache.fetch_lines(self.sitelist_file)
 
         elif os.path.exists(self.sitelist_file):
             self.sitelist = open(self.sitelist_file).read().split('\n')
@@ -180,37 +305,283 @@ class SparrowDriver(object):
             sys.exit(1)
 
         # Add fast.com to extract download speed.  Will be attached to the hyperlink template for analysis later.
-        if json_data.get('poll_download_speed'):
+        # The link probe measures the speed without a pass slot, so fast.com is not needed with it.
+        if json_data.get('poll_download_speed') and not json_data.get('link_probe_url'):
             self.sitelist = ['https://fast.com/'] + self.sitelist
         logging.info("Using sitelist: %s" % self.sitelist_file)
 
-        self.test_label_prefix = json_data.get('test_label_prefix')
-        self.sparrow_only_switches = json_data.get('sparrow_only_switches', '')
-        self.common_switches = json_data.get('common_switches', '')
-
+    def set_user_data_dirs(self, json_data):
         self.alternate_sparrow_chromium = json_data.get('alternate_sparrow_chromiumlike', False)
         self.chromiumlike_only = json_data.get('chromiumlike_only', False)
-        self.alternate_warm_cold_cache = json_data.get('alternate_warm_cold_cache', False)
+        # 'passes' visits the whole sitelist per mode and cache state, 'sequential' visits each site with sparrow and
+        # chromiumlike back to back until its speedup is significant
+        self.schedule = json_data.get('schedule', 'passes')
 
-        if self.alternate_sparrow_chromium  or self.chromiumlike_only:
+        if self.alternate_sparrow_chromium  or self.chromiumlike_only or self.schedule == 'sequential':
             self.chromiumlike_user_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'chromiumlike_user_data')
         self.sparrow_user_data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'sparrow_user_data')
 
         if 'cygwin' in sys.platform.lower():
-            if self.alternate_sparrow_chromium or self.chromiumlike_only:
+            if self.alternate_sparrow_chromium or self.chromiumlike_only or self.schedule == 'sequential':
                 self.chromiumlike_user_data_dir = self.cyg_to_win_path(self.chromiumlike_user_data_dir)
             self.sparrow_user_data_dir = self.cyg_to_win_path(self.sparrow_user_data_dir)
 
+    def setup_tracer(self, json_data):
+        # Where the timing spans of the phases of each site visit go: 'results', 'log' and/or 'histogram'
+        self.tracer = Tracer([EXPORTERS[name]() for name in json_data.get('span_exporters', ['results'])])
+
+    def setup_profile_snapshots(self, json_data):
+        # Start cold and warm passes by restoring a snapshot of the profile instead of deleting cache files
+        self.profile_snapshots = None
+        if json_data.get('profile_snapshots', False):
+            self.profile_snapshots = ProfileSnapshots(json_data.get('profile_snapshot_dir',
+                os.path.join(os.path.dirname(os.path.realpath(__file__)), 'profile_snapshots')))
+
+    def setup_results_file(self, json_data):
+        # One json record per site visit is appended to this file
+        self.results_file = json_data.get('results_file', 'drive_results.jsonl')
+        if getattr(self, 'results_store', None) is not None:
+            self.results_store.close()
+            self.results_store = ResultsStore(self.results_file)
+
+    def setup_screenshots(self, json_data):
+        # Screenshots are written by a background thread, optionally downscaled and skipped when unchanged
+        if getattr(self, 'screenshots', None) is not None:
+            self.screenshots.close()
         self.save_screenshots = json_data.get('save_screenshots', False)
+        self.screenshots = None
+        if self.save_screenshots:
+            self.screenshots = ScreenshotStore(json_data.get('screenshot_dir', './screenshots'),
+                                               max_width=json_data.get('screenshot_max_width'),
+                                               dedupe=json_data.get('screenshot_dedupe', True))
+
+    def setup_link_probe(self, json_data):
+        # Measures throughput and RTT against link_probe_url in the background, the latest reading goes in every result
+        if getattr(self, 'link_probe', None) is not None:
+            self.link_probe.stop()
+        self.link_probe = None
+        if json_data.get('link_probe_url'):
+            self.link_probe = LinkProbe(json_data['link_probe_url'],
+                                        interval=json_data.get('link_probe_interval', 60)).start()
+
+    def setup_browser_logs(self, json_data):
+        # Console logs of each site visit, gzipped per test label in browser_log_dir, with counts per level in the result
+        if getattr(self, 'browser_log_store', None) is not None:
+            self.browser_log_store.close()
+        self.browser_log_store = None
+        if json_data.get('browser_logs', False):
+            self.browser_log_store = CompressedStore(json_data.get('browser_log_dir', 'browser_logs'),
+                                                     lambda entry: entry['test_label'])
+
+    def setup_network_capture(self, json_data):
+        # Requests of each site visit from the performance log, as HAR records gzipped per pass in network_capture_dir
+        if getattr(self, 'network_capture_store', None) is not None:
+            self.network_capture_store.close()
+        self.network_capture_store = None
+        if json_data.get('network_capture', False):
+            self.network_capture_store = CompressedStore(json_data.get('network_capture_dir', 'network_captures'),
+                                                         lambda capture: capture['pass'])
+
+    def setup_replay_proxy(self, json_data):
+        # Browse through a local proxy: 'record' keeps every response in replay_archive, 'replay' serves the pass from
+        # it alone, replay_latency_ms (or replay_origin_latency_ms of the origin) after each request
+        if getattr(self, 'replay_proxy', None) is not None:
+            self.replay_proxy.save()
+            self.replay_proxy.stop()
+        self.replay_proxy = None
+        mode = json_data.get('replay_mode')
+        if not mode:
+            return
+        if mode not in REPLAY_MODES:
+            logging.info("replay_mode must be one of %s, not %s" % (', '.join(REPLAY_MODES), mode))
+            sys.exit(1)
+        self.replay_proxy = ReplayProxy(json_data.get('replay_archive', 'replay_archive'), mode,
+                                        json_data.get('replay_latency_ms', 0),
+                                        json_data.get('replay_origin_latency_ms')).start()
+        if not getattr(self, 'replay_archive_saved_at_exit', False):
+            atexit.register(self.save_replay_archive)
+            self.replay_archive_saved_at_exit = True
+        logging.info("Replay proxy in %s mode at %s" % (mode, self.replay_proxy.proxy_url()))
+
+    def save_replay_archive(self):
+        if self.replay_proxy is not None:
+            self.replay_proxy.save()
+
+    def setup_hint_service(self, json_data):
+        # Point sparrow at a local stand-in for the IHS hint and BEER services instead of the gateway, serving
+        # hint_files (dns_hints.json format) hint_latency_ms late and logging hints and feedback to hint_service_log
+        if getattr(self, 'hint_service', None) is not None:
+            self.hint_service.stop()
+        self.hint_service = None
+        if json_data.get('hint_service', False):
+            self.hint_service = HintService(json_data.get('hint_files', DEFAULT_HINT_FILES),
+                                            json_data.get('hint_latency_ms', 0), json_data.get('hint_ttl'),
+                                            json_data.get('hint_service_log', 'hint_service.log')).start()
+            logging.info("Hint service at %s" % self.hint_service.url())
+
+    def setup_hover_template(self, json_data):
+        # Where load_on_hover gets the page holding the link: 'remote' (HYPERLINK_TEMPLATE_URL, link injected per
+        # site), 'local' (served from this machine with the link in place) or 'data' (a data: URL)
+        if getattr(self, 'hover_template', None) is not None:
+            self.hover_template.stop()
+        mode = json_data.get('hover_template', 'remote')
+        if mode == 'local':
+            self.hover_template = HoverTemplateServer().start()
+        elif mode == 'data':
+            self.hover_template = DataTemplate()
+        else:
+            self.hover_template = None
+
+    def setup_latency_model(self, json_data):
+        # Per-site page load timeouts and ack waits from the history of each site, slowest sites visited first
+        self.latency_model = None
+        if json_data.get('latency_model', False):
+            self.latency_model = LatencyModel(json_data.get('latency_history_file',
+                                                            os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                                                         'latency_history.json')),
+                                              PAGE_LOAD_TIMEOUT, ACK_TIMEOUT,
+                                              margin=json_data.get('latency_margin', 2.0))
+
+    def setup_sequential_tests(self, json_data):
+        # (site, cache_state) -> PairedSequentialTest for the sequential schedule, started over when these change
+        self.sequential_tests = {}
+        self.sequential_alpha = json_data.get('sequential_alpha', 0.05)
+        self.sequential_tau = json_data.get('sequential_tau', 0.1)
+        self.sequential_max_pairs = json_data.get('sequential_max_pairs', 50)
+        # Record value compared: 'load_time' or 'browser_load_time'
+        self.sequential_metric = json_data.get('sequential_metric', 'load_time')
+
+    def apply_settings(self, json_data):
+        '''Sets the config values that are plain attributes, cheap enough to set again on any change'''
+
+        self.percent_clicks_on_hover = json_data.get('percent_clicks_on_hover', 100)
+        self.hover_time = json_data.get('hover_time', selenium_methods.HOVER_TIME)
+
+        self.test_label_prefix = json_data.get('test_label_prefix')
+        self.sparrow_only_switches = json_data.get('sparrow_only_switches', '')
+        self.common_switches = json_data.get('common_switches', '')
+
+        self.alternate_warm_cold_cache = json_data.get('alternate_warm_cold_cache', False)
         self.ublock_path = json_data.get('ublock_path')
 
+        # 'poll' reloads sparrow://beerstatus once a second, 'observe' watches the page in place
+        self.ack_wait_mode = json_data.get('ack_wait_mode', 'poll')
+
+        # Number of browser sessions driven in parallel, each with its own user-data-dir
+        self.concurrency = max(1, int(json_data.get('concurrency', 1)))
+
+        # Run the browser without a window, or in an Xvfb display of its own (read once, at startup), for servers
+        # without a display
+        self.headless = json_data.get('headless', False)
+        self.virtual_display = json_data.get('virtual_display', False)
+
+        # Named link to emulate in every session, it becomes part of the test label
+        self.network_profiles = dict(NETWORK_PROFILES, **json_data.get('network_profiles', {}))
+        self.network_profile = json_data.get('network_profile')
+        if self.network_profile and self.network_profile not in self.network_profiles:
+            logging.info("Unknown network_profile %s, known ones are %s" % (self.network_profile,
+                                                                         ', '.join(sorted(self.network_profiles))))
+            sys.exit(1)
+
+        # Hosts the browser reaches directly rather than through the replay proxy, loopback always is
+        self.replay_bypass = json_data.get('replay_bypass', [])
+
+        # Record the CPU and memory use of the browser after each site, and restart the session between sites once
+        # it uses more than recycle_rss_mb or runs more than recycle_processes processes
+        self.recycle_rss_mb = json_data.get('recycle_rss_mb')
+        self.recycle_processes = json_data.get('recycle_processes')
+        self.sample_browser = json_data.get('sample_browser', False) or bool(self.recycle_rss_mb or
+                                                                              self.recycle_processes)
+
+        # Launch the sessions of the next pass ahead of time and swap out hung content tabs instead of restarting
+        self.warm_standby = json_data.get('warm_standby', False)
+        if getattr(self, 'remote_pool', None) is not None:
+            self.remote_pool.standby = self.warm_standby
+
+    def detect_binary(self, json_data):
+        '''Sets the location and chromium version of the Sparrow binary, and the user agent for chromiumlike mode'''
+
+        # Discover chromium version and set user agent for use in chromiumlike mode
+        if 'darwin' in sys.platform:
+            self.binary_location = json_data.get('sparrow_location_mac',
+                MAC_SPARROW_LOCATION)
+
+            def version():
+                p = subprocess.Popen([self.binary_location, '--version'], stdout=subprocess.PIPE)
+                if p is None:
+                    logging.info("Unable to open Sparrow at : %s" % self.binary_location)
+                    sys.exit(1)
+                out, err = p.communicate()
+                return out.strip().split()[1]
+
+            self.chromium_version = binary_version(self.binary_location, version)
+            self.user_agent = USR_AGENT_OSX % self.chromium_version
+
+        elif sys.platform.startswith('linux'):
+            self.binary_location = json_data.get('sparrow_location_linux')
+            if not self.binary_location:
+                found = [location for location in LINUX_SPARROW_LOCATIONS if os.access(location, os.X_OK)]
+                self.binary_location = found[0] if found else find_executable('sparrow')
+            if not self.binary_location:
+                logging.info("Sparrow not found in %s or on the PATH, set sparrow_location_linux" %
+                             ', '.join(LINUX_SPARROW_LOCATIONS))
+                sys.exit(1)
+
+            def version():
+                try:
+                    out = subprocess.check_output([self.binary_location, '--version'])
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logging.info("Unable to open Sparrow at %s: %s" % (self.binary_location, e))
+                    sys.exit(1)
+                # e.g. "Sparrow 63.0.3239.84" or "Chromium 63.0.3239.84 built on Debian"
+                match = re.search(r'\d+\.\d+\.\d+\.\d+', out)
+                return match.group(0) if match else out.strip().split()[1]
+
+            self.chromium_version = binary_version(self.binary_location, version)
+            self.user_agent = USR_AGENT_LINUX % self.chromium_version
+
+        elif 'win' in sys.platform.lower():
+            self.binary_location = json_data.get('sparrow_location_windows',
+                WINDOWS_SPARROW_LOCATION % self.username)
+
+            def version():
+                if 'cygwin' in sys.platform.lower():
+                    cmd = ['wmic', 'datafile', 'where', r'name="%s"' % self.binary_location.replace('\\', '\\\\'), 'get', 'Version']
+                    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                else:
+                    cmd = r'wmic datafile where name="%s" get Version' % self.binary_location.replace('\\', '\\\\')
+                    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+                if p is None:
+                    logging.info("Unable to open Sparrow at : %s" % self.binary_location)
+                    sys.exit(1)
+                out, err = p.communicate()
+                return out.split()[1]
+
+            self.chromium_version = binary_version(self.binary_location, version)
+            self.user_agent = USR_AGENT_WIN % self.chromium_version
+
     def cyg_to_win_path(self, path):
         return path.replace('/cygdrive/c/', 'C:\\').replace('/', '\\')
 
-    def add_options(self, chromiumlike, cache_state):
+    def user_data_dirs(self, chromiumlike):
+        '''Returns one user-data-dir per session, the first session always uses the configured directory'''
+
+        user_data = self.chromiumlike_user_data_dir if chromiumlike else self.sparrow_user_data_dir
+        return [user_data] + ['%s_%s' % (user_data, index) for index in range(1, self.concurrency)]
+
+    def config_switches(self, switches):
+        '''The switches from the config, less the IHS urls when the local hint service replaces them'''
+
+        if self.hint_service is None:
+            return switches
+        return [switch for switch in switches if not switch.startswith(('--ihs-hint-url=', '--ihs-beer-url='))]
+
+    def add_options(self, chromiumlike, cache_state, user_data_dir=None):
         ''' Sets a bunch of cmd switches and options passed to selenium'''
 
-        mode = "chromiumlike" if chromiumlike else "sparrow"
+        if user_data_dir is None:
+            user_data_dir = self.chromiumlike_user_data_dir if chromiumlike else self.sparrow_user_data_dir
 
         driver_options = Options()
 
@@ -218,20 +589,28 @@ class SparrowDriver(object):
         if chromiumlike:
             driver_options.add_argument('--sparrow-force-fieldtrial=chromiumlike')
             driver_options.add_argument('--user-agent=%s' % self.user_agent)
-            driver_options.add_argument('--user-data-dir=%s' % self.chromiumlike_user_data_dir)
+            driver_options.add_argument('--user-data-dir=%s' % user_data_dir)
 
         else:
             driver_options.add_argument('--sparrow-force-fieldtrial')
-            driver_options.add_argument('--user-data-dir=%s' % self.sparrow_user_data_dir)
-            for switch in self.sparrow_only_switches:
+            driver_options.add_argument('--user-data-dir=%s' % user_data_dir)
+            for switch in self.config_switches(self.sparrow_only_switches):
                 driver_options.add_argument(switch)
                 logging.debug("Adding switch to sparrow only: %s" % switch)
+            if self.hint_service is not None:
+                driver_options.add_argument('--ihs-hint-url=%s' % self.hint_service.hint_url())
 
         # Passed from config file
-        for switch in self.common_switches:
+        for switch in self.config_switches(self.common_switches):
             driver_options.add_argument(switch)
             logging.debug("Adding switch: %s" % switch)
 
+        if self.headless:
+            if self.ublock_path:
+                logging.warning("Extensions don't load in headless mode, ublock will not be used")
+            driver_options.add_argument('--headless')
+            driver_options.add_argument('--window-size=%s,%s' % tuple(VIRTUAL_DISPLAY_SCREEN.split('x')[:2]))
+
         if self.ublock_path:
             if not os.path.exists(self.ublock_path):
                 print("Error, ublock crx file not found.")
@@ -239,186 +618,606 @@ class SparrowDriver(object):
 
             driver_options.add_extension(self.ublock_path)
 
+        if self.hint_service is not None:
+            driver_options.add_argument('--ihs-beer-url=%s' % self.hint_service.beer_url())
+
+        if self.replay_proxy is not None:
+            driver_options.add_argument('--proxy-server=%s' % self.replay_proxy.proxy_url())
+            if self.replay_bypass:
+                driver_options.add_argument('--proxy-bypass-list=%s' % ';'.join(self.replay_bypass))
+            if self.replay_proxy.mitm:
+                driver_options.add_argument('--ignore-certificate-errors')
+
         # Test label
-        test_label_entry = "--beer-test-label=%s-%s-%s-%s-%s-%s" % (self.test_label_prefix, self.chromium_version,
-                                                                    sys.platform, mode, cache_state, self.test_start_time)
+        test_label_entry = "--beer-test-label=%s" % self.test_label(chromiumlike, cache_state)
         driver_options.add_argument(test_label_entry)
         logging.info(test_label_entry)
 
         driver_options.binary_location = self.binary_location
-        driver_options.to_capabilities()['loggingPrefs'] = { 'browser':'ALL' }
+        logging_prefs = {}
+        if self.browser_log_store is not None:
+            logging_prefs['browser'] = 'ALL'
+        if self.network_capture_store is not None:
+            logging_prefs['performance'] = 'ALL'
+            driver_options.add_experimental_option('perfLoggingPrefs', {'enableNetwork': True, 'enablePage': False})
+        if logging_prefs:
+            driver_options.set_capability('loggingPrefs', logging_prefs)
 
         return driver_options
 
-    def visit_sites(self, chromiumlike, cache_state):
+    def prepare_pass(self, chromiumlike, cache_state, standby=False):
+        '''
+        Gets the profiles ready for a pass: restores their snapshots if configured, otherwise clears the caches for a
+        cold pass. With standby also launches the sessions of the pass ahead of time.
+        '''
 
-        driver_options = self.add_options(chromiumlike, cache_state)
-        selenium_methods.stop_sparrow()
+        user_data_dirs = self.user_data_dirs(chromiumlike)
+        options = [self.add_options(chromiumlike, cache_state, user_data_dir) for user_data_dir in user_data_dirs]
+        if all(self.remote_pool.spare_matches(driver_options) for driver_options in options):
+            # Already prepared, the sessions are running on these user-data-dirs
+            return
 
-        # launch sparrow and initial tabs
-        remote, beerstatus_tab, content_tab = selenium_methods.start_remote(self.service.service_url, driver_options)
+        # Spares launched before a config reload changed the options would be rejected by acquire, and were prepared
+        # for another pass, e.g. a cold one. Their browsers have to be gone before their profiles are prepared again.
+        for user_data_dir in user_data_dirs:
+            self.remote_pool.discard(user_data_dir)
 
-        # Used to verify that the current beer is unique and new
-        beer_status_dict = {}
-        for site in self.sitelist:
-            site = site.strip()
-            beer_status_dict[site] = None
+        if self.profile_snapshots:
+            for user_data_dir in user_data_dirs:
+                self.restore_profile(chromiumlike, user_data_dir, cache_state)
+        elif cache_state == 'cold':
+            self.clear_user_data_caches(chromiumlike)
 
-        self.stats['sites'] = 0
-        self.download_speed = None
-        for site in self.sitelist:
-            if not site:
-                continue
+        if standby:
+            for driver_options in options:
+                self.remote_pool.prepare(driver_options)
 
-            site = site.strip()
+    def test_label(self, chromiumlike, cache_state):
+        mode = "chromiumlike" if chromiumlike else "sparrow"
+        if self.network_profile:
+            cache_state = '%s-%s' % (cache_state, self.network_profile)
+        return "%s-%s-%s-%s-%s-%s" % (self.test_label_prefix, self.chromium_version, sys.platform, mode, cache_state,
+                                      self.test_start_time)
 
-            logging.info(site)
+    def visit_sites(self, chromiumlike, cache_state, next_pass=None):
+        '''
+        Visits the sitelist once. next_pass is the (chromiumlike, cache_state) of the pass that follows, if known,
+        so its sessions can be launched on standby while this pass's sessions shut down.
+        '''
 
+        self.download_speed = None
+        self.pass_number += 1
+        self.stats['wait_saved'] = 0
+        user_data_dirs = self.user_data_dirs(chromiumlike)
+
+        if not any(self.remote_pool.has_spare(user_data_dir) for user_data_dir in user_data_dirs):
+            selenium_methods.stop_sparrow(os.path.basename(self.binary_location))
+
+        sitelist = self.ordered_sitelist()
+
+        if len(user_data_dirs) == 1:
+            driver_options = self.add_options(chromiumlike, cache_state, user_data_dirs[0])
+            self.visit_session_sites(chromiumlike, cache_state, driver_options, sitelist, self.stats)
+            self.finish_pass(chromiumlike, next_pass)
+            return
+
+        # Split the sitelist round robin between the sessions, each session drives its own browser
+        # with its own user-data-dir and keeps its own stats, which are merged in when the pass is done.
+        sessions = []
+        for index, user_data_dir in enumerate(user_data_dirs):
+            driver_options = self.add_options(chromiumlike, cache_state, user_data_dir)
+            sessions.append((driver_options, sitelist[index::len(user_data_dirs)], {}))
+
+        def visit_session(args):
+            driver_options, sitelist, stats = args
             try:
-                remote.switch_to_window(content_tab)
-                nav_start_time = time.time()
+                self.visit_session_sites(chromiumlike, cache_state, driver_options, sitelist, stats,
+                                         restart_sparrow=False)
+            except Exception as e:
+                logging.exception("Exception caught in drive session with %s" % driver_options.arguments)
 
-                if site == 'https://fast.com/':
-                    selenium_methods.load_url(site, remote)
-                    self.download_speed = selenium_methods.extract_value_from_page(remote, 'speed-value')
-                    continue
+        logging.info("Visiting %s sites with %s parallel sessions" % (len(sitelist), len(sessions)))
+        pool = ThreadPool(len(sessions))
+        pool.map(visit_session, sessions)
+        pool.close()
+        pool.join()
 
-                else:
-                    if random.randrange(100) < self.percent_clicks_on_hover:
-                        selenium_methods.load_on_hover(site, remote, speed_value=self.download_speed)
-                    else:
-                        selenium_methods.load_url(site, remote)
+        self.stats['sites'] = 0
+        for driver_options, sitelist, stats in sessions:
+            self.merge_stats(stats)
+        logging.info('pass done, stats: %s' % str(self.stats))
+        self.finish_pass(chromiumlike, next_pass)
+
+    def ordered_sitelist(self):
+        if self.latency_model is None:
+            return self.sitelist
+        # History changes with every pass, and sites visited earlier warm the shared resources of the later ones
+        if self.cycle_sitelist is None:
+            self.cycle_sitelist = self.latency_model.order(self.sitelist, pinned=('https://fast.com/',))
+        return self.cycle_sitelist
+
+    def finish_pass(self, chromiumlike, next_pass):
+        self.log_span_histograms()
+        if self.latency_model is not None:
+            try:
+                self.latency_model.save()
+            except (IOError, OSError) as e:
+                logging.warning("Unable to save latency history: %s" % str(e))
+        if self.replay_proxy is not None:
+            try:
+                self.replay_proxy.save()
+            except (IOError, OSError) as e:
+                logging.warning("Unable to save the replay archive: %s" % str(e))
+        if self.hint_service is not None:
+            logging.info("Hint service: %s" % self.hint_service.summary())
+        self.prepare_next_pass(chromiumlike, next_pass)
+
+    def visit_sites_paired(self, cache_state):
+        '''
+        Visits every undecided site of the sitelist with sparrow and chromiumlike back to back, in random order, and
+        feeds the pair to the sequential test of the site. Sites are retired once their test is decided, when all
+        are the results are logged and the tests start over.
+        '''
 
+        self.download_speed = None
+        self.pass_number += 1
+        self.stats['wait_saved'] = 0
+        sites = [site.strip() for site in self.sitelist if site.strip() and site.strip() != 'https://fast.com/']
+        tests = dict((site, self.sequential_tests.setdefault(
+                          (site, cache_state), PairedSequentialTest(self.sequential_alpha, self.sequential_tau,
+                                                                    max_pairs=self.sequential_max_pairs)))
+                     for site in sites)
+
+        undecided = [site for site in sites if not tests[site].decided()]
+        if not undecided:
+            self.log_sequential_tests(cache_state, sites)
+            for site in sites:
+                del self.sequential_tests[(site, cache_state)]
+            return
+        if self.latency_model is not None:
+            undecided = self.latency_model.order(undecided)
+
+        if self.concurrency > 1:
+            logging.warning("concurrency %s is not used by the sequential schedule, which runs one session per mode"
+                            % self.concurrency)
+
+        selenium_methods.stop_sparrow(os.path.basename(self.binary_location))
+        sessions = {}
+        for chromiumlike in (False, True):
+            self.prepare_pass(chromiumlike, cache_state)
+            # Both sessions run at once, restarting sparrow would kill the other one
+            sessions[chromiumlike] = self.open_session(chromiumlike, cache_state,
+                                                       self.add_options(chromiumlike, cache_state),
+                                                       restart_sparrow=False)
+
+        logging.info("Visiting %s of %s sites in pairs, %s cache" % (len(undecided), len(sites), cache_state))
+        stats = {}
+        for pair, site in enumerate(undecided):
+            order = [False, True]
+            random.shuffle(order)
+            fields = {'pair': '%s-%s-%05d-%s' % (self.test_start_time, cache_state, self.pass_number, pair)}
+            records = {}
+            for chromiumlike in order:
+                records[chromiumlike] = self.visit_site(sessions[chromiumlike], site, stats, record_fields=fields)
+
+            # A pair missing either time still counts, so a site that keeps failing gets retired
+            times = [(records[chromiumlike] or {}).get(self.sequential_metric) for chromiumlike in (False, True)]
+            test = tests[site]
+            test.add(*times)
+            if test.decided():
+                logging.info("Retiring %s, %s cache: %s, speedup %.3f after %s pairs (%s failed), p = %.4f" % (
+                    site, cache_state, test.verdict(), test.speedup(), test.pairs, test.failed_pairs, test.p_value))
+
+        for session in sessions.values():
+            self.close_session(session)
+        self.stats['sites'] = 0
+        self.merge_stats(stats)
+        logging.info("%s of %s sites decided, %s cache" % (sum(1 for site in sites if tests[site].decided()),
+                                                           len(sites), cache_state))
+        self.finish_pass(False, None)
+
+    def log_sequential_tests(self, cache_state, sites):
+        for site in sites:
+            test = self.sequential_tests[(site, cache_state)]
+            logging.info("%s, %s cache: %s, speedup %.3f after %s pairs (%s failed), p = %.4f" % (
+                site, cache_state, test.verdict(), test.speedup(), test.pairs, test.failed_pairs, test.p_value))
+
+    def log_span_histograms(self):
+        for exporter in self.tracer.exporters:
+            if isinstance(exporter, HistogramExporter):
+                exporter.log_summary()
+                exporter.reset()
+
+    def prepare_next_pass(self, chromiumlike, next_pass):
+        # A standby session can't share a user-data-dir with a session of this pass
+        if self.warm_standby and next_pass is not None and next_pass[0] != chromiumlike:
+            self.prepare_pass(next_pass[0], next_pass[1], standby=True)
+
+    def merge_stats(self, stats):
+        '''Adds the counters of a session into self.stats, per site values are taken from the last session'''
+
+        for key, value in stats.iteritems():
+            if key in PER_SITE_STATS:
+                self.stats[key] = value
+            else:
+                self.stats[key] = self.stats.get(key, 0) + value
+
+    def visit_session_sites(self, chromiumlike, cache_state, driver_options, sitelist, stats, restart_sparrow=True):
+
+        sites = [site.strip() for site in sitelist if site.strip()]
+        stats['sites'] = 0
+        visited = 0
+        session = None
+        try:
+            session = self.open_session(chromiumlike, cache_state, driver_options, restart_sparrow=restart_sparrow)
+            for site in sites:
+                visited += 1
                 try:
-                    title = remote.find_element_by_tag_name('title').get_property('text')
-                    title.decode('ascii')
-
-                    # Screenshot handling if configured
-                    # Save screenshot only if title present to prevent hang in some cases
-                    if self.save_screenshots:
-                        if title != 'No title':
-                            screenshot_path = './screenshots/' + site.replace(':','_').replace('/', '_') + '.png'
-                            remote.save_screenshot(screenshot_path)
-
-                except UnicodeDecodeError:
-                    title = 'title is not ascii-encoded'
-                    logging.warning(title)
-                except UnicodeEncodeError:
-                    title = 'title is not ascii-encoded'
-                    logging.warning(title)
-                except NoSuchElementException:
-                    title = 'no title because no such element'
-                    logging.warning(title)
-                except WebDriverException:
-                    title = 'no title b/c of exception'
-                    logging.warning(title)
-
-                remote.switch_to_window(beerstatus_tab)
-
-            except TimeoutException as e:
-                logging.warning("Selenium exception caught: %s" % str(e))
-                if 'timeout_errors' not in self.stats:
-                    self.stats['timeout_errors'] = 0
-                self.stats['timeout_errors'] += 1
-                remote.quit()
-                remote, beerstatus_tab, content_tab = selenium_methods.start_remote(self.service.service_url, driver_options)
-                continue
-            except Exception as e:
-                print("Selenium exception caught: %s" % str(e))
-                logging.warning("Selenium exception caught: %s" % str(e))
-                if 'driver_exceptions' not in self.stats:
-                    self.stats['driver_exceptions'] = 0
-                if 'session deleted because of page crash' in str(e):
-                    if 'tab_crash_exceptions' not in self.stats:
-                        self.stats['tab_crash_exceptions'] = 0
-                    self.stats['tab_crash_exceptions'] += 1
-                self.stats['driver_exceptions'] += 1
-                remote.quit()
-                remote, beerstatus_tab, content_tab = selenium_methods.start_remote(self.service.service_url, driver_options)
-                continue
-
-            self.stats['sites'] += 1
-            if 'total' not in self.stats:
-                self.stats['total'] = 0
-            self.stats['total'] += 1
-            nav_done_time = time.time()
-            self.stats['time'] = nav_done_time-nav_start_time
+                    self.visit_site(session, site, stats)
+                except Exception as e:
+                    # visit_site handles the page load, this is the ack wait or a restart failing
+                    logging.exception("Exception caught visiting %s" % site)
+                    stats['site_exceptions'] = stats.get('site_exceptions', 0) + 1
+                    self.restart_session(session)
+        finally:
+            if visited < len(sites):
+                logging.warning("Session failed, skipping its last %s of %s sites" % (len(sites) - visited,
+                                                                                       len(sites)))
+                stats['skipped_sites'] = stats.get('skipped_sites', 0) + len(sites) - visited
+            if session is not None and session.remote is not None:
+                self.close_session(session)
+
+    def open_session(self, chromiumlike, cache_state, driver_options, restart_sparrow=True):
+        '''Launches sparrow and its initial tabs, or takes over a standby session'''
+
+        session = DriveSession(chromiumlike, cache_state, driver_options, self.test_label(chromiumlike, cache_state),
+                               restart_sparrow)
+        session.pass_number = self.pass_number
+        session.remote, session.beerstatus_tab, session.content_tab = self.remote_pool.acquire(
+            driver_options, restart_sparrow=restart_sparrow)
+        self.apply_network_profile(session)
+        return session
+
+    def apply_network_profile(self, session):
+        if not self.network_profile:
+            return
+        profile = self.network_profiles[self.network_profile]
+        try:
+            selenium_methods.set_network_conditions(session.remote, profile['latency_ms'], profile['download_mbps'],
+                                                    profile['upload_mbps'])
+        except WebDriverException as e:
+            logging.warning("Unable to apply network profile %s: %s" % (self.network_profile, str(e)))
+
+    def restart_session(self, session):
+        with self.tracer.span('restart'):
+            self.remote_pool.release(session.remote, session.driver_options)
+            # Nothing left to close if the new session fails to start
+            session.remote = None
+            session.remote, session.beerstatus_tab, session.content_tab = self.remote_pool.acquire(
+                session.driver_options, restart_sparrow=session.restart_sparrow)
+            session.page_load_timeout = None
+            self.apply_network_profile(session)
+
+    def close_session(self, session):
+        self.remote_pool.release(session.remote, session.driver_options)
+
+    def visit_site(self, session, site, stats, record_fields=None):
+        '''
+        Loads site in the content tab of session and waits for its beer ack. Returns the result record, or None for
+        fast.com which is only visited for the download speed.
+        '''
 
-            # Wait up to 40 seconds for beer ack
-            num_tries = 40
-            trys = 0
-            while (trys < num_tries):
-                remote.get("sparrow://beerstatus")
-                if selenium_methods.check_beer_status(site, beer_status_dict, remote):
-                    break
+        remote = session.remote
+
+        # Used to verify that the current beer is unique and new
+        session.beer_status.setdefault(site, None)
+
+        logging.info(site)
+        record = {'site': site, 'mode': session.mode, 'cache_state': session.cache_state,
+                  'test_label': session.test_label, 'timestamp': time.time()}
+        record.update(record_fields or {})
+        if self.network_profile:
+            record['network_profile'] = self.network_profile
+        if self.replay_proxy is not None:
+            record['replay_mode'] = self.replay_proxy.mode
+        if self.link_probe is not None:
+            record['link'] = self.link_probe.latest()
+
+        ack_timeout = ACK_TIMEOUT
+        try:
+            if self.latency_model is not None:
+                ack_timeout = self.latency_model.ack_timeout(site)
+                timeout = self.latency_model.page_load_timeout(site)
+                if timeout != session.page_load_timeout:
+                    remote.set_page_load_timeout(timeout)
+                    session.page_load_timeout = timeout
+                record['page_load_timeout'] = timeout
+                record['ack_timeout'] = ack_timeout
+
+            with self.tracer.span('switch_to_content', record=record):
+                remote.switch_to_window(session.content_tab)
+            nav_start_time = time.time()
+
+            if site == 'https://fast.com/':
+                selenium_methods.load_url(site, remote, stats=stats)
+                self.download_speed = selenium_methods.extract_value_from_page(remote, 'speed-value')
+                if self.browser_log_store is not None:
+                    # Not left for the next site
+                    self.save_browser_log(remote, record)
+                return None
+
+            else:
+                with self.link_probe.loading(record) if self.link_probe is not None else NULL_LOADING:
+                    if random.randrange(100) < self.percent_clicks_on_hover:
+                        speed_value = self.download_speed
+                        if speed_value is None and record.get('link'):
+                            speed_value = '%.1f' % record['link']['download_mbps']
+                        selenium_methods.load_on_hover(site, remote, speed_value=speed_value,
+                                                       tracer=self.tracer, record=record,
+                                                       template=self.hover_template, hover_time=self.hover_time)
+                    else:
+                        selenium_methods.load_url(site, remote, tracer=self.tracer, record=record)
 
-                trys += 1
-                time.sleep(1)
+            try:
+                with self.tracer.span('title', record=record):
+                    title = remote.find_element_by_tag_name('title').get_property('text')
+                title.decode('ascii')
+
+                # Screenshot handling if configured
+                # Save screenshot only if title present to prevent hang in some cases
+                if self.save_screenshots:
+                    if title != 'No title':
+                        with self.tracer.span('screenshot', record=record):
+                            self.screenshots.add(remote.get_screenshot_as_base64(), site, session.pass_name(),
+                                                 mode=session.mode)
+
+            except UnicodeDecodeError:
+                title = 'title is not ascii-encoded'
+                logging.warning(title)
+            except UnicodeEncodeError:
+                title = 'title is not ascii-encoded'
+                logging.warning(title)
+            except NoSuchElementException:
+                title = 'no title because no such element'
+                logging.warning(title)
+            except WebDriverException:
+                title = 'no title b/c of exception'
+                logging.warning(title)
 
-            self.stats['waiting_for_ack'] = time.time()-nav_done_time
-            logging.info('\'%s\', stats: %s' % (title, str(self.stats)))
+            nav_done_time = time.time()
 
-            if trys == num_tries:
-                if 'no beerAck' not in self.stats:
-                    self.stats['no beerAck'] = 0
-                self.stats['no beerAck'] += 1
-                print("No beer ack recieved for %s" % site)
+            # Browser measured timings, the wall clock above includes the template page and webdriver overhead
+            try:
+                with self.tracer.span('navigation_timing', record=record):
+                    navigation_timing = selenium_methods.collect_navigation_timing(remote)
+            except WebDriverException as e:
+                logging.warning("Unable to collect navigation timing: %s" % str(e))
+                navigation_timing = None
+
+            if self.browser_log_store is not None:
+                with self.tracer.span('browser_log', record=record):
+                    self.save_browser_log(remote, record)
+            if self.network_capture_store is not None:
+                with self.tracer.span('network_log', record=record):
+                    self.save_network_capture(remote, session, record, since=nav_start_time)
+
+            with self.tracer.span('switch_to_beerstatus', record=record):
+                remote.switch_to_window(session.beerstatus_tab)
+
+        except TimeoutException as e:
+            logging.warning("Selenium exception caught: %s" % str(e))
+            if 'timeout_errors' not in stats:
+                stats['timeout_errors'] = 0
+            stats['timeout_errors'] += 1
+            record['error'] = e.__class__.__name__
+            # The console of the page that timed out, rather than leaving it to the next site or the restart
+            if self.browser_log_store is not None:
+                self.save_browser_log(remote, record)
+            self.add_result(record)
+            if self.latency_model is not None:
+                self.latency_model.add(site, session.mode, session.cache_state, timed_out=True)
+            if self.warm_standby:
+                try:
+                    with self.tracer.span('replace_content_tab'):
+                        session.content_tab = selenium_methods.replace_content_tab(remote, session.beerstatus_tab,
+                                                                                   session.content_tab)
+                    return record
+                except Exception as e:
+                    logging.warning("Unable to replace content tab, restarting: %s" % str(e))
+            self.restart_session(session)
+            return record
+        except Exception as e:
+            print("Selenium exception caught: %s" % str(e))
+            logging.warning("Selenium exception caught: %s" % str(e))
+            if 'driver_exceptions' not in stats:
+                stats['driver_exceptions'] = 0
+            if 'session deleted because of page crash' in str(e):
+                if 'tab_crash_exceptions' not in stats:
+                    stats['tab_crash_exceptions'] = 0
+                stats['tab_crash_exceptions'] += 1
+            stats['driver_exceptions'] += 1
+            record['error'] = e.__class__.__name__
+            if self.browser_log_store is not None:
+                self.save_browser_log(remote, record)
+            self.add_result(record)
+            self.restart_session(session)
+            return record
+
+        stats['sites'] = stats.get('sites', 0) + 1
+        if 'total' not in stats:
+            stats['total'] = 0
+        stats['total'] += 1
+        stats['time'] = nav_done_time-nav_start_time
+
+        record['load_time'] = stats['time']
+        record['download_speed'] = self.download_speed
+
+        if navigation_timing:
+            navigation = navigation_timing['navigation']
+            if navigation.get('loadEventEnd'):
+                stats['browser_load_time'] = (navigation['loadEventEnd'] - navigation.get('startTime', 0)) / 1000.0
+                record['browser_load_time'] = stats['browser_load_time']
+            record['navigation_timing'] = navigation_timing
+
+        ack_start_time = time.time()
+
+        # Wait up to ack_timeout seconds for beer ack
+        if self.ack_wait_mode == 'observe':
+            with self.tracer.span('ack_wait', record=record):
+                acked = selenium_methods.wait_for_beer_ack(site, session.beer_status, remote, timeout=ack_timeout)
+        else:
+            ack_received = selenium_methods.beer_ack_received(site, session.beer_status, remote, tracer=self.tracer,
+                                                              record=record)
+            # Compared to reloading once a second and sleeping in between, an ack shows up at the next whole second
+            acked = bool(wait_until(ack_received, timeout=ack_timeout, interval=selenium_methods.ACK_POLL_INTERVAL,
+                                    replaces=math.ceil, stats=stats, tracer=self.tracer, name='ack_poll',
+                                    record=record))
+
+        stats['waiting_for_ack'] = time.time()-ack_start_time
+        logging.info('\'%s\', stats: %s' % (title, str(stats)))
+
+        if not acked:
+            if 'no beerAck' not in stats:
+                stats['no beerAck'] = 0
+            stats['no beerAck'] += 1
+            print("No beer ack recieved for %s" % site)
+
+        record['ack_wait'] = stats['waiting_for_ack']
+        record['acked'] = acked
+        sample = self.sample_browser_resources(session)
+        if sample is not None:
+            record['browser'] = sample
+        self.add_result(record)
+        if self.latency_model is not None:
+            self.latency_model.add(site, session.mode, session.cache_state, load_time=record['load_time'],
+                                   ack_wait=record['ack_wait'], acked=acked)
+
+        if sample is not None and self.needs_recycle(sample):
+            logging.info("Recycling session after %s, browser at %.0fMB in %s processes" % (
+                site, sample['rss_mb'], sample['processes']))
+            stats['recycles'] = stats.get('recycles', 0) + 1
+            self.restart_session(session)
+        return record
+
+    def save_browser_log(self, remote, record):
+        try:
+            counts, entries, dropped = selenium_methods.drain_browser_log(remote)
+        except Exception as e:
+            # A timeout comes from the http client rather than webdriver
+            logging.warning("Unable to read the browser log: %s" % str(e))
+            return
+
+        record['console'] = counts
+        if entries:
+            self.browser_log_store.add({'site': record['site'], 'test_label': record['test_label'],
+                                        'timestamp': record['timestamp'], 'entries': entries, 'dropped': dropped})
+
+    def save_network_capture(self, remote, session, record, since):
+        try:
+            page = har.har_page(remote.get_log('performance'), record['site'], since=since)
+        except WebDriverException as e:
+            logging.warning("Unable to read the performance log: %s" % str(e))
+            return
+
+        record['network'] = har.summary(page)
+        self.network_capture_store.add({'site': record['site'], 'test_label': record['test_label'],
+                                        'pass': session.pass_name(), 'timestamp': record['timestamp'],
+                                        'log': dict(page, version='1.2', creator={'name': 'drive.py'})})
+
+    def sample_browser_resources(self, session):
+        if self.browser_monitor is None or not self.sample_browser:
+            return None
+        try:
+            return self.browser_monitor.sample(user_data_dir_of(session.driver_options))
+        except Exception as e:
+            logging.exception("Exception caught sampling browser resources")
+            return None
+
+    def needs_recycle(self, sample):
+        return bool((self.recycle_rss_mb and sample['rss_mb'] > self.recycle_rss_mb) or
+                    (self.recycle_processes and sample['processes'] > self.recycle_processes))
+
+    def add_result(self, record):
+        if self.results_store is not None:
+            self.results_store.add(record)
+
+    def start_virtual_display(self):
+        '''Starts an Xvfb server on the first free display and points DISPLAY, and so the browsers, at it'''
+
+        read_fd, write_fd = os.pipe()
+        xvfb = subprocess.Popen(['Xvfb', '-displayfd', str(write_fd), '-screen', '0', VIRTUAL_DISPLAY_SCREEN,
+                                 '-nolisten', 'tcp'], close_fds=False)
+        os.close(write_fd)
+        display = os.fdopen(read_fd).readline().strip()
+        if not display:
+            logging.info("Unable to start Xvfb, exiting")
+            sys.exit(1)
 
-        remote.quit()
+        atexit.register(xvfb.terminate)
+        os.environ['DISPLAY'] = ':' + display
+        logging.info("Using virtual display :%s" % display)
 
     def run_service(self):
 
+        if self.virtual_display:
+            self.start_virtual_display()
         self.service.start()
+        if psutil is not None:
+            self.browser_monitor = BrowserMonitor(self.service.process.pid)
+        elif self.sample_browser:
+            logging.warning("psutil is not installed, browser resources will not be sampled")
+        self.remote_pool = RemotePool(self.service.service_url, standby=self.warm_standby)
+        self.results_store = ResultsStore(self.results_file)
 
         self.stats['total'] = 0
 
-        if self.save_screenshots:
-            if not os.path.exists('./screenshots'):
-                os.mkdir( './screenshots', 0755 );
-
         # Loop forever togging between sparrow and chromiumlike modes if alternate_sparrow_chromium = True
         # Alternate cold and warm cache between runs through the list
         clear_cache = True
         chromiumlike_mode = True if self.chromiumlike_only else False
         mode = 'chromiumlike' if self.chromiumlike_only else 'sparrow'
 
-        browsing_data_dir = 'Default'
-        cache_dir = 'Cache'
-        cache_files = ['Cookies', 'Cookies-journal', 'History', 'History-journal']
         while True:
-            if clear_cache:
-                user_data = self.chromiumlike_user_data_dir if chromiumlike_mode else self.sparrow_user_data_dir
-                self.clear_cache(cache_directory=os.path.join(user_data, browsing_data_dir, cache_dir),
-                                 browsing_data_directory=os.path.join(user_data, browsing_data_dir),
-                                 files_list=cache_files)
+            # A new cycle, both modes with the same cache state
+            self.cycle_sitelist = None
+            next_clear_cache = not clear_cache if self.alternate_warm_cold_cache else False
+            next_pass = (not chromiumlike_mode, "cold" if clear_cache else "warm") if self.alternate_sparrow_chromium else None
+            # The pass after the second one of the pair, back in the first mode
+            rollover_pass = (chromiumlike_mode, "cold" if next_clear_cache else "warm")
+            if self.schedule == 'sequential':
+                self.visit_sites_paired("cold" if clear_cache else "warm")
+
+            elif clear_cache:
+                self.prepare_pass(chromiumlike_mode, "cold")
 
                 logging.info("Starting cold cache run with %s now" % mode)
-                self.visit_sites(chromiumlike_mode, "cold")
+                self.visit_sites(chromiumlike_mode, "cold", next_pass=next_pass)
 
                 if self.alternate_sparrow_chromium:
                     chromiumlike_mode = not chromiumlike_mode
                     mode = "chromiumlike" if chromiumlike_mode else "sparrow"
 
-                    user_data = self.chromiumlike_user_data_dir if chromiumlike_mode else self.sparrow_user_data_dir
-                    self.clear_cache(cache_directory=os.path.join(user_data, browsing_data_dir, cache_dir),
-                                     browsing_data_directory=os.path.join(user_data, browsing_data_dir),
-                                     files_list=cache_files)
+                    self.prepare_pass(chromiumlike_mode, "cold")
 
                     logging.info("Starting cold cache run with %s now" % mode)
-                    self.visit_sites(chromiumlike_mode, "cold")
+                    self.visit_sites(chromiumlike_mode, "cold", next_pass=rollover_pass)
 
             else:
+                self.prepare_pass(chromiumlike_mode, "warm")
+
                 logging.info("Starting warm cache run with %s now.." % mode)
-                self.visit_sites(chromiumlike_mode, "warm")
+                self.visit_sites(chromiumlike_mode, "warm", next_pass=next_pass)
 
                 if self.alternate_sparrow_chromium:
                     chromiumlike_mode = not chromiumlike_mode
                     mode = "chromiumlike" if chromiumlike_mode else "sparrow"
 
+                    self.prepare_pass(chromiumlike_mode, "warm")
+
                     logging.info("Starting warm cache run with %s now" % mode)
-                    self.visit_sites(chromiumlike_mode, "warm")
+                    self.visit_sites(chromiumlike_mode, "warm", next_pass=rollover_pass)
 
-            clear_cache = not clear_cache if self.alternate_warm_cold_cache else False
+            clear_cache = next_clear_cache
             if self.alternate_sparrow_chromium:
                 chromiumlike_mode = not chromiumlike_mode
                 mode = "chromiumlike" if chromiumlike_mode else "sparrow"
@@ -433,7 +1232,7 @@ class SparrowDriver(object):
                     json_data = self.load_remote_config()
                     logging.info(json_data)
                     # Set new config values to be run till next iteration
-                    self.json_config_parser(json_data)
+                    self.reload_config(json_data)
                     
                     if self.chromiumlike_only:
                         chromiumlike_mode = True
@@ -448,6 +1247,58 @@ class SparrowDriver(object):
                     message_str = "Failed to load remote config at %s." % self.remote_config_file
                     logging.info(message_str)
 
+    def restore_profile(self, chromiumlike, user_data_dir, cache_state):
+        '''
+        Restores the snapshot for the cache state of user_data_dir. The first time round the snapshot is captured
+        instead: the cold one from a new profile that a clean browser launch has set up, the warm one from the profile
+        as the pass before left it.
+        '''
+
+        # The session that last used the profile may still be shutting down, and the browser may still be writing
+        # out the profile after the quit returned
+        self.remote_pool.wait_for_quit(user_data_dir)
+        if not wait_until(profile_unlocked(user_data_dir), timeout=PROFILE_UNLOCK_TIMEOUT):
+            logging.warning("%s is still locked after %ss" % (user_data_dir, PROFILE_UNLOCK_TIMEOUT))
+
+        name = '%s-%s' % (os.path.basename(user_data_dir), cache_state)
+        if self.profile_snapshots.exists(name):
+            self.profile_snapshots.restore(name, user_data_dir)
+            return
+
+        if cache_state == 'cold':
+            self.capture_fresh_profile(name, chromiumlike, user_data_dir)
+            self.profile_snapshots.restore(name, user_data_dir)
+        else:
+            self.profile_snapshots.capture(name, user_data_dir)
+
+    def capture_fresh_profile(self, name, chromiumlike, user_data_dir):
+        '''
+        Captures snapshot name from an empty user-data-dir after one launch of the browser, so that it holds no
+        service workers, code cache or site storage of earlier passes
+        '''
+
+        fresh_dir = '%s.fresh' % user_data_dir
+        shutil.rmtree(fresh_dir, ignore_errors=True)
+        remote = selenium_methods.start_remote(self.remote_pool.service_url,
+                                               self.add_options(chromiumlike, 'cold', fresh_dir),
+                                               restart_sparrow=False)[0]
+        try:
+            remote.quit()
+        except WebDriverException as e:
+            logging.warning("Unable to quit the session that set up %s: %s" % (fresh_dir, str(e)))
+        if not wait_until(profile_unlocked(fresh_dir), timeout=PROFILE_UNLOCK_TIMEOUT):
+            logging.warning("%s is still locked after %ss" % (fresh_dir, PROFILE_UNLOCK_TIMEOUT))
+        self.profile_snapshots.capture(name, fresh_dir)
+        self.profile_snapshots.discard(fresh_dir)
+
+    def clear_user_data_caches(self, chromiumlike):
+        '''Clears the cache of the user-data-dir of every session for the given mode'''
+
+        for user_data in self.user_data_dirs(chromiumlike):
+            self.clear_cache(cache_directory=os.path.join(user_data, BROWSING_DATA_DIR, CACHE_DIR),
+                             browsing_data_directory=os.path.join(user_data, BROWSING_DATA_DIR),
+                             files_list=CACHE_FILES)
+
     def clear_cache(self, cache_directory, browsing_data_directory=None, files_list=[]):
 
         if 'cygwin' in sys.platform.lower():
@@ -483,6 +1334,17 @@ class SparrowDriver(object):
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'report':
+        import report
+        sys.exit(report.main(sys.argv[2:]))
+
+    if sys.platform.startswith('linux'):
+        # stop_sparrow only kills the browsers in our process group, make sure it is ours alone
+        try:
+            os.setpgrp()
+        except OSError:
+            pass
+
     sdrv = SparrowDriver()
 
     try:
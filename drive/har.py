@@ -0,0 +1,152 @@
+'''
+Turns the chromedriver performance log of a site visit into a HAR style record.
+
+  entries = remote.get_log('performance')
+  page = har_page(entries, site, since=nav_start_time)
+
+The performance log holds the DevTools Network events of the session, one json message per log entry. Requests are
+put back together from requestWillBeSent, responseReceived, requestServedFromCache, loadingFinished and loadingFailed,
+and each becomes a HAR entry with its timings, whether it reused a connection and whether it came from a cache.
+Fields HAR has no place for start with an underscore, as in the HAR files Chrome itself exports.
+'''
+
+import datetime
+import json
+
+# Requests that belong to the harness rather than the site
+IGNORED_URLS = ('sparrow://', 'data:', 'about:', 'chrome-extension://')
+IGNORED_PAGES = ('/hyperlink_template.html',)
+
+
+def iso_time(wall_time):
+    return datetime.datetime.utcfromtimestamp(wall_time).isoformat() + 'Z'
+
+
+def ignored(url):
+    return url.startswith(IGNORED_URLS) or any(page in url for page in IGNORED_PAGES)
+
+
+def phase(timing, start, end):
+    '''Milliseconds between two ResourceTiming marks, -1 when the phase did not happen'''
+
+    if timing.get(start, -1) < 0 or timing.get(end, -1) < 0:
+        return -1
+    return timing[end] - timing[start]
+
+
+def har_timings(timing, finished):
+    '''HAR timings from a ResourceTiming, with finished the monotonic time in seconds the load was done'''
+
+    if not timing:
+        return {'blocked': -1, 'dns': -1, 'connect': -1, 'ssl': -1, 'send': 0, 'wait': 0, 'receive': 0}
+
+    # connect includes ssl in both ResourceTiming and HAR
+    marks = [value for value in (timing.get('dnsStart', -1), timing.get('connectStart', -1),
+                                 timing.get('sendStart', -1)) if value >= 0]
+    receive = (finished - timing['requestTime']) * 1000 - timing['receiveHeadersEnd'] if finished else 0
+    return {'blocked': min(marks) if marks else -1,
+            'dns': phase(timing, 'dnsStart', 'dnsEnd'),
+            'connect': phase(timing, 'connectStart', 'connectEnd'),
+            'ssl': phase(timing, 'sslStart', 'sslEnd'),
+            'send': phase(timing, 'sendStart', 'sendEnd'),
+            'wait': phase(timing, 'sendEnd', 'receiveHeadersEnd'),
+            'receive': max(0, receive)}
+
+
+def har_page(log_entries, site, since=None):
+    '''
+    Returns {'pages': [...], 'entries': [...]} in HAR 1.2 layout for the requests in log_entries that started after
+    the wall clock time since.
+    '''
+
+    requests = {}
+    for log_entry in log_entries:
+        try:
+            message = json.loads(log_entry['message'])['message']
+        except (KeyError, ValueError):
+            continue
+        method = message.get('method', '')
+        params = message.get('params', {})
+        request_id = params.get('requestId')
+        if not method.startswith('Network.') or request_id is None:
+            continue
+
+        if method == 'Network.requestWillBeSent':
+            request = params['request']
+            if ignored(request['url']) or (since is not None and params.get('wallTime', since) < since):
+                continue
+            if request_id in requests:
+                # A redirect reuses the request id, keep the hop as an entry of its own
+                hop = requests.pop(request_id)
+                hop['response'] = params.get('redirectResponse', {})
+                hop['finished'] = params['timestamp']
+                requests['%s:%s' % (request_id, len(requests))] = hop
+            requests[request_id] = {'request': request, 'wall_time': params.get('wallTime'),
+                                    'started': params['timestamp'], 'initiator': params.get('initiator', {}),
+                                    'type': params.get('type')}
+            continue
+
+        request = requests.get(request_id)
+        if request is None:
+            continue
+        if method == 'Network.responseReceived':
+            request['response'] = params['response']
+        elif method == 'Network.requestServedFromCache':
+            request['memory_cache'] = True
+        elif method == 'Network.loadingFinished':
+            request['finished'] = params['timestamp']
+            request['size'] = params.get('encodedDataLength', 0)
+        elif method == 'Network.loadingFailed':
+            request['finished'] = params['timestamp']
+            request['error'] = params.get('errorText')
+
+    entries = []
+    for request in requests.values():
+        if request['wall_time'] is None:
+            continue
+        response = request.get('response', {})
+        if request.get('memory_cache'):
+            cache = 'memory'
+        elif response.get('fromDiskCache'):
+            cache = 'disk'
+        elif response.get('fromServiceWorker'):
+            cache = 'service_worker'
+        else:
+            cache = None
+
+        finished = request.get('finished')
+        timings = har_timings(response.get('timing'), finished)
+        entries.append({
+            'pageref': site,
+            'startedDateTime': iso_time(request['wall_time']),
+            'time': (finished - request['started']) * 1000 if finished else -1,
+            'request': {'method': request['request'].get('method'), 'url': request['request']['url'],
+                        'headers': [{'name': name, 'value': value}
+                                    for name, value in sorted(request['request'].get('headers', {}).items())]},
+            'response': {'status': response.get('status', 0), 'mimeType': response.get('mimeType'),
+                         'bodySize': request.get('size', -1), 'httpVersion': response.get('protocol')},
+            'cache': {},
+            'timings': timings,
+            'serverIPAddress': response.get('remoteIPAddress'),
+            'connection': str(response.get('connectionId')) if response.get('connectionId') else None,
+            '_connectionReused': response.get('connectionReused'),
+            '_fromCache': cache,
+            '_initiator': request['initiator'].get('type'),
+            '_resourceType': request['type'],
+            '_error': request.get('error'),
+        })
+
+    entries.sort(key=lambda entry: entry['startedDateTime'])
+    started = entries[0]['startedDateTime'] if entries else iso_time(since or 0)
+    return {'pages': [{'id': site, 'title': site, 'startedDateTime': started, 'pageTimings': {}}],
+            'entries': entries}
+
+
+def summary(page):
+    '''Counts for the result record of the visit'''
+
+    entries = page['entries']
+    return {'requests': len(entries),
+            'cache_hits': sum(1 for entry in entries if entry['_fromCache']),
+            'reused_connections': sum(1 for entry in entries if entry['_connectionReused']),
+            'failed': sum(1 for entry in entries if entry['_error'])}
@@ -0,0 +1,205 @@
+'''
+Local stand-in for the IHS hint and BEER feedback services, so hinting can be benchmarked end to end without the
+production gateway.
+
+  service = HintService(['dns_hints.json'], latency_ms=50, ttl=600, log_file='hint_service.log').start()
+  driver_options.add_argument('--ihs-hint-url=%s' % service.hint_url())
+  driver_options.add_argument('--ihs-beer-url=%s' % service.beer_url())
+
+Hint files hold Hint.hostHint messages in the format of dns_hints.json: either a list, served for every hint
+request, or an object mapping page urls or host names to the list served when a request names one of them. A
+request names a page with a url, pageUrl, hostUrl or host field, in its query string or its json body. Served hints
+get the id of the request and an expire time ahead of now, since the recorded ones are long past: ttl seconds ahead
+with that TTL on their addresses, otherwise the longest TTL of their addresses or DEFAULT_TTL ahead.
+
+Requests to /feedback are BEER uploads, they are acked with a 200. Every request waits latency_ms before its
+answer, like a round trip to the gateway, and is logged to log_file as a json line with the hints it got or the body
+it fed back.
+
+python hint_service.py [hint files] [--port 8090] runs the service on its own.
+'''
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import urlparse
+import zlib
+
+from local_server import LocalServer, QuietHandler, REPO_ROOT
+
+DEFAULT_HINT_FILES = (os.path.join(REPO_ROOT, 'dns_hints.json'),)
+NAME_FIELDS = ('url', 'pageUrl', 'hostUrl', 'host')
+# Seconds a hint is valid for without a ttl, when none of its addresses has a TTL
+DEFAULT_TTL = 600
+# Characters of a request or upload body kept in the log
+LOG_MAX_BODY = 2000
+
+
+def normalize(name):
+    return name.rstrip('/').lower()
+
+
+def parse_body(body):
+    try:
+        message = json.loads(body) if body else {}
+    except ValueError:
+        return {}
+    return message if isinstance(message, dict) else {}
+
+
+def requested_names(query, body):
+    '''Page urls and host names a hint request asks about, normalized, from its query string or json body'''
+
+    fields = dict((name, values[0]) for name, values in urlparse.parse_qs(query).items())
+    message = parse_body(body)
+    fields.update(message)
+    if isinstance(message.get('params'), dict):
+        fields.update(message['params'])
+
+    names = []
+    for field in NAME_FIELDS:
+        value = fields.get(field)
+        if not value or not isinstance(value, basestring):
+            continue
+        names.append(normalize(value))
+        host = urlparse.urlparse(value).hostname
+        if host:
+            names.append(normalize(host))
+    return names, fields.get('hintRequestId') or fields.get('id')
+
+
+def loggable(body):
+    return body[:LOG_MAX_BODY].decode('utf-8', 'replace')
+
+
+class HintHandler(QuietHandler):
+
+    def do_request(self):
+        parsed = urlparse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            try:
+                body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                pass
+
+        path = parsed.path.rstrip('/')
+        if path.endswith('/hint'):
+            self.serve_hints(parsed.query, body)
+        elif path.endswith('/feedback'):
+            self.ack_feedback(body)
+        else:
+            self.send_error(404)
+
+    do_GET = do_POST = do_request
+
+    def serve_hints(self, query, body):
+        names, request_id = requested_names(query, body)
+        hints = self.server.hints_for(names, request_id)
+        self.server.log({'type': 'hint', 'names': names, 'hosts': [hint['params'].get('hostUrl') for hint in hints],
+                         'request': loggable(body)})
+        self.server.count('hint_requests')
+        time.sleep(self.server.latency_ms / 1000.0)
+        self.send_body(json.dumps(hints), 'application/json')
+
+    def ack_feedback(self, body):
+        self.server.log({'type': 'feedback', 'bytes': len(body), 'content_type': self.headers.get('Content-Type'),
+                         'body': loggable(body)})
+        self.server.count('feedback')
+        time.sleep(self.server.latency_ms / 1000.0)
+        self.send_body('{}', 'application/json')
+
+
+class HintService(LocalServer):
+
+    def __init__(self, hint_files=DEFAULT_HINT_FILES, latency_ms=0, ttl=None, log_file=None, port=0):
+        LocalServer.__init__(self, HintHandler, port)
+        self.latency_ms = latency_ms
+        self.ttl = ttl
+        self.log_file = log_file
+        self.log_lock = threading.Lock()
+        # Hints for requests that don't name a page or host of hints_by_name
+        self.default_hints = []
+        self.hints_by_name = {}
+        for path in hint_files:
+            self.load(path)
+        self.request_ids = itertools.count(1)
+        self.counts = {'hint_requests': 0, 'hints': 0, 'feedback': 0}
+        self.counts_lock = threading.Lock()
+
+    def load(self, path):
+        with open(path) as fl:
+            hints = json.load(fl)
+        if isinstance(hints, dict):
+            for name, name_hints in hints.items():
+                self.hints_by_name.setdefault(normalize(name), []).extend(name_hints)
+        else:
+            self.default_hints.extend(hints)
+
+    def hint_url(self):
+        return self.url('hint')
+
+    def beer_url(self):
+        return self.url('feedback')
+
+    def hints_for(self, names, request_id=None):
+        source = next((self.hints_by_name[name] for name in names if name in self.hints_by_name), self.default_hints)
+        hints = copy.deepcopy(source)
+        request_id = str(request_id if request_id is not None else next(self.request_ids))
+        now = time.time()
+        for hint in hints:
+            params = hint.setdefault('params', {})
+            params['hintRequestId'] = request_id
+            addresses = params.get('ipList', [])
+            if self.ttl is not None:
+                ttl = self.ttl
+                for address in addresses:
+                    address['timeToLive'] = int(self.ttl)
+            else:
+                ttl = max([address.get('timeToLive', 0) for address in addresses] + [0]) or DEFAULT_TTL
+            params['hintExpireTime'] = now + ttl
+        self.count('hints', len(hints))
+        return hints
+
+    def count(self, name, value=1):
+        with self.counts_lock:
+            self.counts[name] += value
+
+    def log(self, entry):
+        if self.log_file is None:
+            return
+        entry['time'] = time.time()
+        with self.log_lock:
+            with open(self.log_file, 'a') as fl:
+                fl.write(json.dumps(entry) + '\n')
+
+    def summary(self):
+        return "%(hint_requests)s hint requests, %(hints)s hints served, %(feedback)s BEER uploads acked" % self.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve hints from files and ack BEER uploads')
+    parser.add_argument('hint_files', nargs='*', default=DEFAULT_HINT_FILES, help='files like dns_hints.json')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every answer')
+    parser.add_argument('--ttl', type=float, help='seconds the served hints are valid for, by default the TTL of '
+                                                  'their addresses')
+    parser.add_argument('--log', help='json lines log of the hints served and the feedback received')
+    args = parser.parse_args()
+
+    service = HintService(args.hint_files, args.latency_ms, args.ttl, args.log, port=args.port)
+    print("--ihs-hint-url=%s --ihs-beer-url=%s" % (service.hint_url(), service.beer_url()))
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(service.summary())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+'''
+Per-site history of page load and beer ack times, kept across runs.
+
+  model = LatencyModel('latency_history.json')
+  remote.set_page_load_timeout(model.page_load_timeout(site))
+  ...
+  model.add(site, 'sparrow', 'cold', load_time=..., ack_wait=..., acked=True)
+  model.save()
+
+Visits are kept per site and arm, the mode and cache state of the visit. Once every arm a site has been visited in
+has MIN_SAMPLES visits, its page load timeout and ack wait are the p99 of the slowest arm times a margin, clamped
+between a floor and the global defaults. Fast sites stop waiting as long as the slowest site would, while every arm of
+a site is cut off at the same time, so that a fast sparrow or warm arm doesn't time out the slower loads of the other
+arms and leave them out of the comparison.
+'''
+
+import json
+import logging
+import math
+import os
+import threading
+
+from atomic_write import atomic_write
+
+# Visits kept per site
+HISTORY = 50
+
+# Visits needed before a site gets its own timeouts
+MIN_SAMPLES = 5
+
+# Budgets are p99 * MARGIN, but never below MIN_BUDGET seconds
+MARGIN = 2.0
+MIN_BUDGET = 5
+
+
+def percentile(values, percentile):
+    '''Nearest rank percentile of a non-empty list'''
+
+    values = sorted(values)
+    rank = int(math.ceil(percentile / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class LatencyModel(object):
+
+    def __init__(self, path, page_load_timeout, ack_timeout, margin=MARGIN, history=HISTORY):
+        self.path = path
+        self.default_page_load_timeout = page_load_timeout
+        self.default_ack_timeout = ack_timeout
+        self.margin = margin
+        self.history = history
+        self.lock = threading.Lock()
+        # site -> arm -> {'load': [seconds], 'ack': [seconds, acked visits only]}
+        self.sites = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as fl:
+                sites = json.load(fl)
+        except (IOError, ValueError) as e:
+            logging.warning("Unable to read latency history %s, starting a new one: %s" % (self.path, e))
+            return {}
+        # Histories from before visits were kept per arm have 'load' at the top, they mix all arms and are dropped
+        return dict((site, arms) for site, arms in sites.items() if 'load' not in arms)
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.sites)
+        atomic_write(self.path, data)
+
+    def add(self, site, mode, cache_state, load_time=None, ack_wait=None, acked=False, timed_out=False):
+        with self.lock:
+            if timed_out:
+                # The load took at least as long as the timeout it hit
+                load_time = self.budget_locked(site, 'load', self.default_page_load_timeout)
+            history = self.sites.setdefault(site, {}).setdefault('%s-%s' % (mode, cache_state), {'load': [], 'ack': []})
+            if load_time is not None:
+                history['load'] = (history['load'] + [load_time])[-self.history:]
+            if acked and ack_wait is not None:
+                history['ack'] = (history['ack'] + [ack_wait])[-self.history:]
+
+    def budget(self, values, default):
+        if len(values) < MIN_SAMPLES:
+            return default
+        return max(MIN_BUDGET, min(default, int(math.ceil(percentile(values, 99) * self.margin))))
+
+    def budget_locked(self, site, kind, default):
+        '''Budget of the slowest arm of site, the default until every arm has enough visits'''
+
+        arms = self.sites.get(site, {}).values()
+        if not arms:
+            return default
+        return max(self.budget(arm[kind], default) for arm in arms)
+
+    def page_load_timeout(self, site):
+        with self.lock:
+            return self.budget_locked(site, 'load', self.default_page_load_timeout)
+
+    def ack_timeout(self, site):
+        with self.lock:
+            return self.budget_locked(site, 'ack', self.default_ack_timeout)
+
+    def expected_time(self, site):
+        '''Median load plus ack time of a site, None if it has never been visited'''
+
+        with self.lock:
+            arms = self.sites.get(site, {}).values()
+            loads = [value for arm in arms for value in arm['load']]
+            acks = [value for arm in arms for value in arm['ack']]
+            if not loads:
+                return None
+            return percentile(loads, 50) + (percentile(acks, 50) if acks else 0)
+
+    def order(self, sitelist, pinned=()):
+        '''
+        Returns sitelist with the slowest sites first, so that when the list is split between parallel sessions the
+        slow sites are spread out and no session is left finishing a run of them alone. Sites never visited keep
+        their place after the known ones, pinned sites stay at the front.
+        '''
+
+        front = [site for site in sitelist if site.strip() in pinned]
+        rest = [site for site in sitelist if site.strip() and site.strip() not in pinned]
+        known = [(self.expected_time(site.strip()), index, site) for index, site in enumerate(rest)]
+        slow_first = sorted((item for item in known if item[0] is not None), key=lambda item: (-item[0], item[1]))
+        return front + [site for _, _, site in slow_first] + [site for time, _, site in known if time is None]
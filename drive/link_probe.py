@@ -0,0 +1,190 @@
+'''
+Measures the download throughput and round trip time of the link in a background thread, so the drive loop can tag
+every result with the latest reading instead of spending a pass slot on fast.com.
+
+  probe = LinkProbe('http://probe.example.com/10MB.bin', interval=60).start()
+  record['link'] = probe.latest()
+
+  with probe.loading(record):
+      <load the page>
+
+RTT is the best of a few TCP connects to the host of the url, throughput is the size of one download of the url over
+the time it took after the first byte arrived. Downloads stop after max_bytes or max_seconds.
+
+The download would compete with the page loads it is meant to explain, so it waits for a gap between the loads
+wrapped in loading() and starts over if a load begins while it runs. When no gap comes within interval seconds it
+runs through the loads, and loading() marks the records of loads it overlapped with link_probe_overlap.
+
+For testing, python link_probe.py --serve 8000 runs a stand-in endpoint at http://127.0.0.1:8000/probe?bytes=N,
+and python link_probe.py <url> measures once.
+'''
+
+import argparse
+import logging
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+from contextlib import contextmanager
+
+from local_server import LocalServer, ProbeHandler
+from spans import clock
+
+PROBE_INTERVAL = 60
+RTT_SAMPLES = 3
+MAX_BYTES = 25 * 1024 * 1024
+MAX_SECONDS = 10
+CHUNK_SIZE = 64 * 1024
+
+
+class NullLoading(object):
+    '''What a load is wrapped in when there is no probe'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_LOADING = NullLoading()
+
+
+class LinkProbe(object):
+
+    def __init__(self, url, interval=PROBE_INTERVAL, timeout=30, max_bytes=MAX_BYTES, max_seconds=MAX_SECONDS):
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.reading = None
+        # Page loads in progress, downloads started so far and whether one is running, guarded by idle
+        self.loads = 0
+        self.downloads = 0
+        self.downloading = False
+        self.idle = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='link-probe')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    @contextmanager
+    def loading(self, record=None):
+        '''Wraps a page load: holds back the throughput download, and marks record if a download ran during it'''
+
+        with self.idle:
+            self.loads += 1
+            overlapped = self.downloading
+            downloads = self.downloads
+        try:
+            yield
+        finally:
+            with self.idle:
+                self.loads -= 1
+                overlapped = overlapped or self.downloading or self.downloads != downloads
+                self.idle.notify_all()
+            if overlapped and record is not None:
+                record['link_probe_overlap'] = True
+
+    def latest(self):
+        '''The last reading, {'download_mbps', 'rtt_ms', 'probe_time'}, or None before the first one'''
+
+        return self.reading
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.reading = self.measure()
+                logging.info("Link probe: %.1f Mbps, %.1f ms RTT" % (self.reading['download_mbps'],
+                                                                    self.reading['rtt_ms']))
+            except Exception as e:
+                logging.warning("Link probe of %s failed: %s" % (self.url, e))
+            self.stopped.wait(self.interval)
+
+    def rtt(self):
+        parsed = urlparse.urlparse(self.url)
+        port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        samples = []
+        for _ in range(RTT_SAMPLES):
+            start = clock()
+            connection = socket.create_connection((parsed.hostname, port), self.timeout)
+            samples.append(clock() - start)
+            connection.close()
+        return min(samples)
+
+    def wait_for_gap(self, deadline):
+        '''Waits until no page load is running or deadline, returns whether the download can yield to loads'''
+
+        with self.idle:
+            while self.loads and not self.stopped.is_set():
+                remaining = deadline - clock()
+                if remaining <= 0:
+                    break
+                self.idle.wait(min(remaining, 1))
+            self.downloading = True
+            self.downloads += 1
+            return not self.loads
+
+    def throughput(self):
+        '''Bits per second of one download of url, not counting the time to the first byte'''
+
+        deadline = clock() + self.interval
+        while True:
+            yielding = self.wait_for_gap(deadline)
+            try:
+                bits = self.download(yielding)
+            finally:
+                with self.idle:
+                    self.downloading = False
+            if bits is not None:
+                return bits
+
+    def download(self, yielding):
+        '''Bits per second of one download, None if yielding and a page load started'''
+
+        response = urllib2.urlopen(self.url, timeout=self.timeout)
+        try:
+            received = len(response.read(1))
+            start = clock()
+            while received < self.max_bytes and clock() - start < self.max_seconds:
+                if yielding and self.loads:
+                    return None
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+            elapsed = clock() - start
+        finally:
+            response.close()
+        return received * 8 / elapsed if elapsed > 0 else 0.0
+
+    def measure(self):
+        rtt = self.rtt()
+        return {'download_mbps': self.throughput() / 1e6, 'rtt_ms': rtt * 1000, 'probe_time': time.time()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the link once, or serve a stand-in probe endpoint')
+    parser.add_argument('url', nargs='?', help='url to download')
+    parser.add_argument('--serve', type=int, metavar='PORT', help='serve /probe?bytes=N on this port')
+    args = parser.parse_args()
+
+    if args.serve:
+        server = LocalServer(ProbeHandler, port=args.serve)
+        print("Serving %s" % server.url('probe?bytes=%s' % MAX_BYTES))
+        server.serve_forever()
+    elif args.url:
+        print(LinkProbe(args.url).measure())
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
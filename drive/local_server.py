@@ -0,0 +1,162 @@
+'''
+Small HTTP servers run in a background thread on the loopback interface.
+
+  HoverTemplateServer serves the hyperlink template with the link to the site already in place, so load_on_hover
+  doesn't have to navigate to bizzbyster.github.io and inject the link for every site.
+  DataTemplate gives the same page as a data: URL, without any server. The speed_test value is not passed on.
+  StaticServer serves the files of a directory, by default this repo, and answers revalidations with a 304.
+  ProbeHandler answers /probe?bytes=N with N bytes, a stand-in download for link_probe.
+'''
+
+import cgi
+import email.utils
+import os
+import socket
+import threading
+import urllib
+import urlparse
+import BaseHTTPServer
+import SimpleHTTPServer
+import SocketServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Same page as sitelists/hyperlink_template.html, with the link filled in
+HOVER_TEMPLATE = '''<!DOCTYPE html>
+<html>
+<head>
+    <title>Template Site for Inserting Hyperlinks</title>
+</head>
+<body class="post-template">
+<main class="content" role="main">
+<div id='put_hyperlink_here'><a href="%(url)s">%(text)s</a></div>
+</main>
+</body>
+</html>
+'''
+
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), handler_class)
+        self.thread = threading.Thread(target=self.serve_forever, name=self.__class__.__name__)
+        self.thread.daemon = True
+
+    def url(self, path=''):
+        return 'http://127.0.0.1:%s/%s' % (self.server_address[1], path.lstrip('/'))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class QuietHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, content_type='text/html; charset=utf-8', code=200):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def hover_template_page(url, text):
+    return HOVER_TEMPLATE % {'url': cgi.escape(url, quote=True), 'text': cgi.escape(text)}
+
+
+class HoverTemplateHandler(QuietHandler):
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        url = query.get('url', [''])[0]
+        text = query.get('text', ['Click Me Please'])[0]
+        self.send_body(hover_template_page(url, text))
+
+
+class HoverTemplateServer(LocalServer):
+
+    def __init__(self, port=0):
+        LocalServer.__init__(self, HoverTemplateHandler, port)
+
+    def template_url(self, url, text, speed_value=None):
+        query = [('url', url), ('text', text)]
+        if speed_value:
+            query.append(('speed_test', speed_value))
+        return self.url('hyperlink_template.html?' + urllib.urlencode(query))
+
+
+class DataTemplate(object):
+
+    def template_url(self, url, text, speed_value=None):
+        return 'data:text/html;charset=utf-8,' + urllib.quote(hover_template_page(url, text))
+
+    def stop(self):
+        pass
+
+
+class ProbeHandler(QuietHandler):
+
+    CHUNK = '\0' * 64 * 1024
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        remaining = int(query.get('bytes', [1024 * 1024])[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(remaining))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        while remaining > 0:
+            chunk = self.CHUNK[:remaining]
+            self.wfile.write(chunk)
+            remaining -= len(chunk)
+
+    # The probe stops reading once it has measured enough, that is not an error
+    def handle(self):
+        try:
+            QuietHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            QuietHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class StaticServer(LocalServer):
+
+    def __init__(self, root=REPO_ROOT, port=0):
+        self.root = root
+        server = self
+
+        class Handler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(self, path)
+                return os.path.join(server.root, os.path.relpath(path, os.getcwd()))
+
+            def send_head(self):
+                # Unlike the python 3 one, the python 2 server ignores If-Modified-Since
+                path = self.translate_path(self.path)
+                since = email.utils.parsedate_tz(self.headers.get('If-Modified-Since', ''))
+                if since and os.path.isfile(path) and int(os.path.getmtime(path)) <= email.utils.mktime_tz(since):
+                    self.send_response(304)
+                    self.end_headers()
+                    return None
+                return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        LocalServer.__init__(self, Handler, port)
@@ -23,6 +23,7 @@ from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException
 from selenium.common.exceptions import NoSuchElementException, WebDriverException, NoSuchWindowException
 from selenium.webdriver.common.action_chains import ActionChains
+from selenium_methods import read_beer_status
 
 user = 'peter'
 #binary_location= '/Users/pete/Git/src/out/Release/Sparrow.app/Contents/MacOS/Sparrow'
@@ -34,34 +35,7 @@ sitelist_url = 'http://bizzbyster.github.io/sitelists/https.txt'
 #sitelist_url = 'http://bizzbyster.github.io/sitelists/top5_from_top200.txt'
 
 def check_beer_status(url, beer_status_dict, remote):
-
-    beer_entries = remote.find_elements_by_class_name("component")
-    # Examine each entry in the table.
-    for beer in beer_entries:
-        text = str(beer.text)
-        if url in text:
-            # Populate the beer_dict from the sparrow://beerstatus entry
-            beer_dict = {}
-            for line in text.split('\n'):
-                entry = line.split(':', 1)
-                beer_dict[entry[0]] = entry[1].strip()
-
-            acked = beer_dict.get('Acked')
-            if acked == '-1':
-                print("Beer Ack is misconfigured, will not check for Ack.")
-                return True
-            elif acked == '0':
-                print("Sparrow did not receive beer ack for %s" % url)
-                return True
-            elif (acked == '1' and
-                  beer_dict.get('GUID') != beer_status_dict[url]):
-                beer_status_dict[url] = beer_dict['GUID']
-                return True
-        else:
-            # Not the entry we are looking for.
-            continue
-
-    return False
+    return read_beer_status(remote).check_ack(url, beer_status_dict)
 
 def start_remote(url, capabilities):
   remote = webdriver.Remote(service.service_url, capabilities)
@@ -0,0 +1,91 @@
+'''
+Named snapshots of browser user-data-dirs.
+
+A snapshot is captured once from a user-data-dir and can then be restored over it to get the browser back to a
+known state, instead of deleting the parts of the profile we know about. Restoring clones the snapshot with
+copy-on-write reflinks (cp -c on APFS, cp --reflink on btrfs/xfs) when the filesystem supports it and falls back
+to a plain copy. Hardlinks are not used: the browser updates files like Cookies and History in place, which would
+modify the snapshot as well.
+'''
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+
+class ProfileSnapshots(object):
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        # None until we know whether the filesystem supports reflinks
+        self.reflink = None
+
+    def path(self, name):
+        return os.path.join(self.snapshot_dir, name)
+
+    def exists(self, name):
+        return os.path.isdir(self.path(name))
+
+    def capture(self, name, user_data_dir):
+        '''Saves user_data_dir as snapshot name, replacing an older snapshot of that name'''
+
+        logging.info("Capturing profile snapshot %s from %s" % (name, user_data_dir))
+        if not os.path.exists(self.snapshot_dir):
+            os.makedirs(self.snapshot_dir)
+
+        # Copy next to the final location first so a half written snapshot is never used
+        staging = self.path(name) + '.staging'
+        shutil.rmtree(staging, ignore_errors=True)
+        if os.path.isdir(user_data_dir):
+            self.clone_tree(user_data_dir, staging)
+        else:
+            os.makedirs(staging)
+
+        self.discard(self.path(name))
+        os.rename(staging, self.path(name))
+
+    def restore(self, name, user_data_dir):
+        '''Replaces user_data_dir with a copy of snapshot name'''
+
+        start_time = time.time()
+        self.discard(user_data_dir)
+        self.clone_tree(self.path(name), user_data_dir)
+        logging.info("Restored profile snapshot %s to %s in %.2fs" % (name, user_data_dir, time.time() - start_time))
+
+    def clone_tree(self, source, destination):
+        parent = os.path.dirname(os.path.abspath(destination))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        if 'darwin' in sys.platform:
+            cmd = ['cp', '-c', '-R', source, destination]
+        elif sys.platform.startswith('linux'):
+            cmd = ['cp', '-a', '--reflink=always', source, destination]
+        else:
+            cmd = None
+
+        if cmd is not None and self.reflink is not False:
+            with open(os.devnull, 'w') as devnull:
+                self.reflink = subprocess.call(cmd, stdout=devnull, stderr=devnull) == 0
+            if self.reflink:
+                return
+            logging.info("Reflinks not supported under %s, copying profile snapshots" % parent)
+            shutil.rmtree(destination, ignore_errors=True)
+
+        shutil.copytree(source, destination, symlinks=True)
+
+    def discard(self, directory):
+        '''Moves directory out of the way and deletes it in the background'''
+
+        if not os.path.exists(directory):
+            return
+
+        trash = '%s.trash-%s' % (directory, int(time.time() * 1000))
+        os.rename(directory, trash)
+        thread = threading.Thread(target=shutil.rmtree, args=(trash, True), name='discard-%s' % trash)
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,193 @@
+'''
+On-disk cache for remote sitelists and config files.
+
+Every fetch revalidates the cached copy with If-None-Match / If-Modified-Since, so an unchanged file costs a 304
+and is served from memory without being parsed again. When the fetch fails the last good copy is used.
+
+A cached copy is two files, the content and its meta, written in that order. The meta holds the sha1 of the content
+it belongs to, a copy whose meta doesn't match (the process died between the two writes) is still a good fallback
+but is fetched in full rather than revalidated.
+
+python remote_cache.py checks all three cases against a local server.
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+import urllib2
+
+from atomic_write import atomic_write
+from local_server import StaticServer
+
+FETCH_TIMEOUT = 30
+
+
+class RemoteCache(object):
+
+    def __init__(self, cache_dir, timeout=FETCH_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        # url -> (sha1 of the content it was parsed from, parsed value)
+        self.parsed = {}
+
+    def paths(self, url):
+        name = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cache_dir, name), os.path.join(self.cache_dir, name + '.json')
+
+    def load(self, url):
+        '''Returns (content, meta) of the cached copy of url, or (None, {})'''
+
+        content_path, meta_path = self.paths(url)
+        try:
+            with open(content_path, 'rb') as fl:
+                content = fl.read()
+            with open(meta_path) as fl:
+                meta = json.load(fl)
+        except (IOError, ValueError):
+            return None, {}
+        if meta.get('sha1') != hashlib.sha1(content).hexdigest():
+            logging.warning("Cached copy of %s doesn't match its meta, fetching it in full" % url)
+            return content, {}
+        return content, meta
+
+    def save(self, url, content, meta):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        content_path, meta_path = self.paths(url)
+        atomic_write(content_path, content)
+        # Last, load only trusts the validators of the content the meta was written for
+        atomic_write(meta_path, json.dumps(dict(meta, sha1=hashlib.sha1(content).hexdigest())))
+
+    def fetch(self, url):
+        '''Returns the content of url, from the cache if the server says it has not changed or can't be reached'''
+
+        content, meta = self.load(url)
+
+        request = urllib2.Request(url)
+        if content is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+            fetched = response.read()
+        except urllib2.HTTPError as e:
+            if e.code == 304 and content is not None:
+                logging.debug("%s not modified, using cached copy" % url)
+                return content
+            if content is None:
+                raise
+            logging.warning("Fetching %s failed with %s, using last good copy" % (url, e.code))
+            return content
+        except (urllib2.URLError, socket.error, socket.timeout) as e:
+            if content is None:
+                raise
+            logging.warning("Fetching %s failed: %s, using last good copy" % (url, e))
+            return content
+
+        self.save(url, fetched, {'etag': response.info().getheader('ETag'),
+                                 'last_modified': response.info().getheader('Last-Modified')})
+        return fetched
+
+    def fetch_parsed(self, url, parse):
+        '''Returns parse(content of url), parsing again only when the content changed'''
+
+        content = self.fetch(url)
+        digest = hashlib.sha1(content).hexdigest()
+        cached = self.parsed.get(url)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+
+        value = parse(content)
+        self.parsed[url] = (digest, value)
+        return value
+
+    def fetch_lines(self, url):
+        return self.fetch_parsed(url, lambda content: content.split('\n'))
+
+    def fetch_json(self, url):
+        return self.fetch_parsed(url, json.loads)
+
+
+def expect(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check():
+    '''
+    Runs a cache against a StaticServer: a fresh copy is revalidated with a 304 and not parsed again, a changed file is
+    fetched and parsed again, an unreachable server falls back to the last good copy, also for a new cache on the same
+    directory, and a copy whose meta doesn't match its content is fetched in full. A url never fetched raises.
+    '''
+
+    root = tempfile.mkdtemp()
+    server = StaticServer(root).start()
+    statuses = []
+
+    class Handler(server.RequestHandlerClass):
+        def log_request(self, code='-', size='-'):
+            statuses.append(code)
+
+    server.RequestHandlerClass = Handler
+    config_path = os.path.join(root, 'config.json')
+    url = server.url('config.json')
+    cache = RemoteCache(os.path.join(root, 'cache'))
+    try:
+        with open(config_path, 'w') as fl:
+            json.dump({'pass': 1}, fl)
+        first = cache.fetch_json(url)
+        expect(first == {'pass': 1} and statuses == [200], "first fetch: %s %s" % (first, statuses))
+
+        fresh = cache.fetch_json(url)
+        expect(fresh is first and statuses[-1] == 304, "fresh copy: %s %s" % (fresh, statuses))
+
+        with open(config_path, 'w') as fl:
+            json.dump({'pass': 2}, fl)
+        # Last-Modified has a resolution of a second
+        os.utime(config_path, (time.time() + 2, time.time() + 2))
+        stale = cache.fetch_json(url)
+        expect(stale == {'pass': 2} and statuses[-1] == 200, "stale copy: %s %s" % (stale, statuses))
+
+        server.stop()
+        expect(cache.fetch_json(url) == {'pass': 2}, "unreachable server")
+        expect(RemoteCache(cache.cache_dir).fetch_json(url) == {'pass': 2}, "unreachable server, new cache")
+
+        # As if the process died after writing the content of a new copy, but before its meta
+        server = StaticServer(root, port=server.server_address[1]).start()
+        server.RequestHandlerClass = Handler
+        content_path, meta_path = cache.paths(url)
+        with open(content_path, 'wb') as fl:
+            fl.write('{"pass": 3}')
+        torn = RemoteCache(cache.cache_dir).fetch_json(url)
+        expect(torn == {'pass': 2} and statuses[-1] == 200, "content without its meta: %s %s" % (torn, statuses))
+        server.stop()
+        try:
+            RemoteCache(os.path.join(root, 'empty')).fetch_json(url)
+        except urllib2.URLError:
+            pass
+        else:
+            raise AssertionError("unreachable server without a cached copy did not raise")
+    finally:
+        server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def main():
+    argparse.ArgumentParser(description='Check the cache against a local server').parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    check()
+    print("fresh, stale, unreachable and torn copies: ok")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+'''
+Keeps fully initialized browser sessions (browser launched, beerstatus and content tabs open) ready ahead of time,
+so that a pass rollover is a handle swap instead of a cold browser launch, and quits finished sessions in the
+background instead of blocking the drive loop on the browser shutdown.
+
+Sparrow only runs one browser per user-data-dir, so a spare can only be launched for a user-data-dir that no other
+session is using, e.g. the chromiumlike pass that follows a sparrow pass with alternate_sparrow_chromiumlike.
+'''
+
+import logging
+import threading
+
+try:
+    import selenium_methods
+except:
+    from lift_acceptance_tests.steps import selenium_methods
+
+
+def user_data_dir_of(driver_options):
+    for argument in driver_options.arguments:
+        if argument.startswith('--user-data-dir='):
+            return argument.split('=', 1)[1]
+    return None
+
+
+class RemotePool(object):
+
+    def __init__(self, service_url, standby=True):
+        self.service_url = service_url
+        self.standby = standby
+        self.lock = threading.Lock()
+        # user-data-dir -> (thread, driver_options, result); result holds the start_remote handles once launched
+        self.spares = {}
+        # user-data-dir -> thread quitting a session that used it
+        self.quitting = {}
+
+    def has_spare(self, user_data_dir):
+        with self.lock:
+            return user_data_dir in self.spares
+
+    def spare_matches(self, driver_options):
+        '''Whether acquire would use the spare for driver_options, rather than reject it for other options'''
+
+        with self.lock:
+            spare = self.spares.get(user_data_dir_of(driver_options))
+        return spare is not None and spare[1].arguments == driver_options.arguments
+
+    def discard(self, user_data_dir):
+        '''Quits the spare launched on user_data_dir, if any, and waits until its browser is gone'''
+
+        with self.lock:
+            spare = self.spares.pop(user_data_dir, None)
+        if spare is None:
+            return
+        thread, driver_options, result = spare
+        thread.join()
+        logging.info("Discarding standby session for %s" % user_data_dir)
+        if result:
+            self.quit(result[0], user_data_dir)
+        self.wait_for_quit(user_data_dir)
+
+    def prepare(self, driver_options):
+        '''Launches a session for driver_options in the background, to be picked up by acquire'''
+
+        if not self.standby:
+            return
+
+        key = user_data_dir_of(driver_options)
+        result = []
+
+        def launch():
+            self.wait_for_quit(key)
+            try:
+                result.extend(selenium_methods.start_remote(self.service_url, driver_options, restart_sparrow=False))
+            except Exception as e:
+                logging.exception("Exception caught launching standby session for %s" % key)
+
+        with self.lock:
+            if key in self.spares:
+                return
+            thread = threading.Thread(target=launch, name='standby-%s' % key)
+            thread.daemon = True
+            self.spares[key] = (thread, driver_options, result)
+
+        logging.info("Launching standby session for %s" % key)
+        thread.start()
+
+    def acquire(self, driver_options, restart_sparrow=True):
+        '''Returns (remote, beerstatus_tab, content_tab), from a prepared spare if one matches driver_options'''
+
+        key = user_data_dir_of(driver_options)
+        with self.lock:
+            spare = self.spares.pop(key, None)
+
+        if spare is not None:
+            thread, spare_options, result = spare
+            thread.join()
+            if result and spare_options.arguments == driver_options.arguments:
+                logging.info("Using standby session for %s" % key)
+                return tuple(result)
+
+            logging.info("Standby session for %s is not usable, starting a new one" % key)
+            if result:
+                self.quit(result[0], key)
+                self.wait_for_quit(key)
+
+        self.wait_for_quit(key)
+        return selenium_methods.start_remote(self.service_url, driver_options, restart_sparrow=restart_sparrow)
+
+    def release(self, remote, driver_options):
+        '''Quits a session, in the background when running with standby sessions'''
+
+        key = user_data_dir_of(driver_options)
+        if self.standby:
+            self.quit(remote, key)
+            return
+
+        try:
+            remote.quit()
+        except Exception as e:
+            logging.exception("Exception caught quitting session for %s" % key)
+
+    def quit(self, remote, key):
+
+        def quit_remote():
+            try:
+                remote.quit()
+            except Exception as e:
+                logging.exception("Exception caught quitting session for %s" % key)
+
+        # Only one quit per user-data-dir at a time
+        self.wait_for_quit(key)
+        thread = threading.Thread(target=quit_remote, name='quit-%s' % key)
+        thread.daemon = True
+        thread.start()
+        with self.lock:
+            self.quitting[key] = thread
+
+    def wait_for_quit(self, key):
+        with self.lock:
+            thread = self.quitting.pop(key, None)
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        '''Quits all spares and waits for all pending quits'''
+
+        with self.lock:
+            spares = self.spares.values()
+            self.spares = {}
+        for thread, driver_options, result in spares:
+            thread.join()
+            if result:
+                self.quit(result[0], user_data_dir_of(driver_options))
+
+        with self.lock:
+            keys = list(self.quitting.keys())
+        for key in keys:
+            self.wait_for_quit(key)
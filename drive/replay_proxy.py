@@ -0,0 +1,360 @@
+'''
+Record and replay proxy, so that sitelist passes can run offline and see the same content every time.
+
+  proxy = ReplayProxy('archives/500top', mode='record').start()
+  driver_options.add_argument('--proxy-server=%s' % proxy.proxy_url())
+  ...
+  proxy.save()
+
+In record mode every request is forwarded to its origin and the response is kept in the archive. In replay mode
+responses come from the archive only, after the latency configured for their origin, and requests that were never
+recorded get a 404. The archive is a directory holding index.json, which maps "METHOD url" to the status, headers and
+body of the response, and the bodies in bodies/, named by their sha1 so that resources shared by sites are stored
+once. A replayed url that was not recorded as is gets the response of the same url with another query string, if
+there is one, since many urls carry timestamps or cache busters.
+
+https requests come in as CONNECT tunnels. When openssl is available the proxy ends the tunnel itself with a
+self-signed certificate kept in the archive and handles the requests inside it like any other, which browsers only
+accept with --ignore-certificate-errors (see mitm). Without openssl tunnels are passed through unrecorded in record
+mode, and refused in replay mode. Websockets are not supported, and browsers speak HTTP/1.1 through the proxy.
+
+python replay_proxy.py <archive> --record|--replay [--port 8080] runs the proxy on its own.
+'''
+
+import argparse
+import hashlib
+import httplib
+import json
+import logging
+import os
+import select
+import socket
+import ssl
+import subprocess
+import threading
+import time
+import urlparse
+from distutils.spawn import find_executable
+
+from atomic_write import atomic_write
+from local_server import LocalServer, QuietHandler
+
+MODES = ('record', 'replay')
+ARCHIVE_INDEX = 'index.json'
+CERTIFICATE_FILE = 'proxy-cert.pem'
+KEY_FILE = 'proxy-key.pem'
+ORIGIN_TIMEOUT = 30
+TUNNEL_BUFFER = 64 * 1024
+
+# Headers about one connection rather than the response, they are neither forwarded nor recorded
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection', 'te',
+              'trailer', 'transfer-encoding', 'upgrade')
+
+# Headers that let the origin answer with a 304 or 412 instead of the response, not forwarded while recording so
+# that the archive always holds full responses
+CONDITIONAL = ('if-match', 'if-none-match', 'if-modified-since', 'if-unmodified-since', 'if-range')
+
+
+def request_key(method, url, body=None):
+    if body:
+        return '%s %s %s' % (method, url, hashlib.sha1(body).hexdigest())
+    return '%s %s' % (method, url)
+
+
+def query_free_key(key):
+    method, url = key.split(' ')[:2]
+    return '%s %s' % (method, url.split('?', 1)[0])
+
+
+def header_pairs(message):
+    '''The headers of an httplib message as [name, value] pairs, repeated headers like Set-Cookie kept apart'''
+
+    pairs = []
+    for line in message.headers:
+        if line[:1] in ' \t' and pairs:
+            pairs[-1][1] += ' ' + line.strip()
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            pairs.append([name.strip(), value.strip()])
+    return pairs
+
+
+def make_certificate(directory):
+    '''Returns (certfile, keyfile) of the self-signed certificate of the archive, None without openssl'''
+
+    certfile = os.path.join(directory, CERTIFICATE_FILE)
+    keyfile = os.path.join(directory, KEY_FILE)
+    if not os.path.exists(certfile):
+        openssl = find_executable('openssl')
+        if openssl is None:
+            logging.warning("openssl not found, https will not be recorded or replayed")
+            return None
+        with open(os.devnull, 'w') as devnull:
+            try:
+                subprocess.check_call([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '3650',
+                                       '-subj', '/CN=drive replay proxy', '-keyout', keyfile, '-out', certfile],
+                                      stdout=devnull, stderr=devnull)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.warning("Unable to create the proxy certificate: %s" % str(e))
+                return None
+    return certfile, keyfile
+
+
+class Archive(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.bodies = os.path.join(directory, 'bodies')
+        self.lock = threading.Lock()
+        self.entries = {}
+        # query_free_key -> key of the first response recorded for it
+        self.query_free = {}
+        self.changed = False
+        if not os.path.isdir(self.bodies):
+            os.makedirs(self.bodies)
+        index = os.path.join(directory, ARCHIVE_INDEX)
+        if os.path.exists(index):
+            with open(index) as fl:
+                for key, entry in json.load(fl).items():
+                    self.add_entry(key, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_entry(self, key, entry):
+        self.entries[key] = entry
+        self.query_free.setdefault(query_free_key(key), key)
+
+    def add(self, key, status, reason, headers, body):
+        if status == 304:
+            # Only conditional requests get these, and they carry no response to replay
+            return
+        digest = hashlib.sha1(body).hexdigest()
+        path = os.path.join(self.bodies, digest)
+        with self.lock:
+            if not os.path.exists(path):
+                with open(path, 'wb') as fl:
+                    fl.write(body)
+            self.add_entry(key, {'status': status, 'reason': reason, 'headers': headers, 'body': digest,
+                                 'recorded': time.time()})
+            self.changed = True
+
+    def get(self, key):
+        '''Returns (entry, body) recorded for key, or for key with another query string, None if there is neither'''
+
+        entry = self.entries.get(key) or self.entries.get(self.query_free.get(query_free_key(key)))
+        if entry is None:
+            return None
+        with open(os.path.join(self.bodies, entry['body']), 'rb') as fl:
+            return entry, fl.read()
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            data = json.dumps(self.entries)
+            self.changed = False
+        atomic_write(os.path.join(self.directory, ARCHIVE_INDEX), data)
+
+
+class ReplayHandler(QuietHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # 'https://host[:port]' while the connection carries a CONNECT tunnel
+    tunnel = None
+
+    def do_CONNECT(self):
+        host, _, port = self.path.partition(':')
+        port = int(port or 443)
+        if self.server.ssl_context is None:
+            if self.server.mode == 'record':
+                self.pass_through(host, port)
+            else:
+                self.send_error(502, 'https is not replayed without a proxy certificate')
+            return
+
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        try:
+            self.request = self.server.ssl_context.wrap_socket(self.connection, server_side=True)
+        except (ssl.SSLError, socket.error) as e:
+            logging.debug("TLS handshake for %s failed: %s" % (self.path, str(e)))
+            self.close_connection = 1
+            return
+        # New rfile and wfile over the TLS socket, handle() goes on reading requests from the tunnel, even after an
+        # HTTP/1.0 CONNECT
+        self.setup()
+        self.close_connection = 0
+        self.tunnel = 'https://%s' % host if port == 443 else 'https://%s:%s' % (host, port)
+
+    def pass_through(self, host, port):
+        try:
+            upstream = socket.create_connection((host, port), ORIGIN_TIMEOUT)
+        except socket.error as e:
+            self.send_error(502, str(e))
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.close_connection = 1
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, failed = select.select(sockets, [], sockets, ORIGIN_TIMEOUT)
+                if failed or not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(TUNNEL_BUFFER)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+
+    def do_request(self):
+        url = self.tunnel + self.path if self.tunnel else self.path
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        key = request_key(self.command, url, body)
+
+        if self.server.mode == 'record':
+            response = self.fetch(url, body)
+            if response is None:
+                self.server.count('failed')
+                self.send_error(502)
+                return
+            self.server.archive.add(key, *response)
+            self.server.count('recorded')
+            status, reason, headers, body = response
+        else:
+            found = self.server.archive.get(key)
+            if found is None:
+                logging.debug("Not in the archive: %s" % key)
+                self.server.count('misses')
+                self.send_error(404)
+                return
+            self.server.count('replayed')
+            entry, body = found
+            status, reason, headers = entry['status'], entry['reason'], entry['headers']
+            time.sleep(self.server.latency(url))
+
+        # Not send_response, that would add a second Date and Server header
+        self.wfile.write('%s %d %s\r\n' % (self.protocol_version, status, reason))
+        for name, value in headers:
+            if name.lower() not in HOP_BY_HOP and name.lower() != 'content-length':
+                self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_OPTIONS = do_PATCH = do_request
+
+    def fetch(self, url, body):
+        '''Returns (status, reason, headers, body) of url from its origin, None if it could not be reached'''
+
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme == 'https':
+            connection = httplib.HTTPSConnection(parsed.netloc, timeout=ORIGIN_TIMEOUT,
+                                                 context=self.server.origin_context)
+        else:
+            connection = httplib.HTTPConnection(parsed.netloc, timeout=ORIGIN_TIMEOUT)
+        path = urlparse.urlunsplit(('', '', parsed.path or '/', parsed.query, ''))
+        headers = dict((name, value) for name, value in self.headers.items()
+                       if name.lower() not in HOP_BY_HOP and name.lower() not in CONDITIONAL)
+        try:
+            connection.request(self.command, path, body or None, headers)
+            response = connection.getresponse()
+            return response.status, response.reason, header_pairs(response.msg), response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            logging.debug("Unable to record %s: %s" % (url, str(e)))
+            return None
+        finally:
+            connection.close()
+
+    # Browsers drop connections they no longer need, that is not an error
+    def handle(self):
+        try:
+            QuietHandler.handle(self)
+        except socket.error:
+            pass
+
+    def finish(self):
+        try:
+            QuietHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class ReplayProxy(LocalServer):
+
+    def __init__(self, archive_dir, mode='replay', latency_ms=0, origin_latency_ms=None, port=0):
+        if mode not in MODES:
+            raise ValueError("mode must be one of %s, not %s" % (', '.join(MODES), mode))
+        LocalServer.__init__(self, ReplayHandler, port)
+        self.mode = mode
+        self.archive = Archive(archive_dir)
+        self.latency_ms = latency_ms
+        # 'https://www.example.com' or 'www.example.com' -> milliseconds
+        self.origin_latency_ms = origin_latency_ms or {}
+        self.counts = dict((name, 0) for name in ('recorded', 'replayed', 'misses', 'failed'))
+        self.counts_lock = threading.Lock()
+
+        self.ssl_context = None
+        certificate = make_certificate(archive_dir)
+        if certificate is not None:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.ssl_context.load_cert_chain(*certificate)
+        # The archive is only for benchmarking, and browsers accept chains python can't build (they fetch missing
+        # intermediates), so origins are not verified while recording
+        self.origin_context = ssl.create_default_context()
+        self.origin_context.check_hostname = False
+        self.origin_context.verify_mode = ssl.CERT_NONE
+
+    @property
+    def mitm(self):
+        '''Whether https goes through the archive, browsers then need --ignore-certificate-errors'''
+
+        return self.ssl_context is not None
+
+    def proxy_url(self):
+        return self.url().rstrip('/')
+
+    def latency(self, url):
+        parsed = urlparse.urlsplit(url)
+        origin = '%s://%s' % (parsed.scheme, parsed.netloc)
+        return self.origin_latency_ms.get(origin, self.origin_latency_ms.get(parsed.hostname,
+                                                                             self.latency_ms)) / 1000.0
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] += 1
+
+    def save(self):
+        self.archive.save()
+        logging.info("Replay proxy (%s): %s responses in %s, %s" % (
+            self.mode, len(self.archive), self.archive.directory,
+            ', '.join('%s %s' % (name, value) for name, value in sorted(self.counts.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record responses into an archive, or replay them from it')
+    parser.add_argument('archive', help='archive directory')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--record', action='store_const', dest='mode', const='record')
+    group.add_argument('--replay', action='store_const', dest='mode', const='replay')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every replayed response')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    proxy = ReplayProxy(args.archive, args.mode, args.latency_ms, port=args.port)
+    print("Proxy at %s, https %s" % (proxy.proxy_url(), 'through the archive' if proxy.mitm else 'passed through'))
+    try:
+        proxy.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        proxy.save()
+
+
+if __name__ == '__main__':
+    main()
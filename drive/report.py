@@ -0,0 +1,323 @@
+'''
+What:
+  Compares sparrow against chromiumlike from the results files written by drive.py.
+  Prints p50/p95/p99 load time and ack wait for each mode and cache state, overall and optionally per site,
+  and the sparrow speedup over chromiumlike with a bootstrap confidence interval.
+
+How:
+  Needs numpy ("pip install numpy").
+
+  Usage: python drive.py report drive_results.jsonl [more results files] [--label mv_early] [--per-site]
+
+  The parsed columns of a results file are cached next to it in <results file>.npz. Results files are append-only,
+  so the next report only parses the lines added since. A results file that was replaced rather than appended to is
+  told apart by its inode and first bytes, and parsed again from the start.
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+MODES = ['sparrow', 'chromiumlike']
+CACHE_STATES = ['cold', 'warm']
+METRICS = ['load_time', 'browser_load_time', 'ack_wait']
+PERCENTILES = [50, 95, 99]
+
+# Bumped whenever the cached columns change
+CACHE_VERSION = 2
+
+# Bytes at the start of a results file that are part of its fingerprint
+FINGERPRINT_BYTES = 4096
+
+
+class Results(object):
+    '''Columns of a results file: strings are stored as integer codes into the sites and labels arrays'''
+
+    def __init__(self, columns, sites, labels):
+        self.columns = columns
+        self.sites = sites
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.columns['site'])
+
+
+def empty_columns():
+    columns = {'site': np.zeros(0, np.int32), 'label': np.zeros(0, np.int32),
+               'mode': np.zeros(0, np.int8), 'cache_state': np.zeros(0, np.int8),
+               'error': np.zeros(0, bool)}
+    for metric in METRICS:
+        columns[metric] = np.zeros(0, np.float64)
+    return columns
+
+
+def parse_lines(lines, sites, labels):
+    '''Parses result lines into new column arrays, adding unseen sites and labels to the code lists'''
+
+    site_codes = dict((site, code) for code, site in enumerate(sites))
+    label_codes = dict((label, code) for code, label in enumerate(labels))
+    rows = {'site': [], 'label': [], 'mode': [], 'cache_state': [], 'error': []}
+    for metric in METRICS:
+        rows[metric] = []
+
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('mode') not in MODES or record.get('cache_state') not in CACHE_STATES:
+            continue
+
+        site = record.get('site')
+        if site not in site_codes:
+            site_codes[site] = len(sites)
+            sites.append(site)
+        label = record.get('test_label') or ''
+        if label not in label_codes:
+            label_codes[label] = len(labels)
+            labels.append(label)
+
+        rows['site'].append(site_codes[site])
+        rows['label'].append(label_codes[label])
+        rows['mode'].append(MODES.index(record['mode']))
+        rows['cache_state'].append(CACHE_STATES.index(record['cache_state']))
+        rows['error'].append('error' in record)
+        for metric in METRICS:
+            value = record.get(metric)
+            rows[metric].append(float(value) if value is not None else np.nan)
+
+    columns = empty_columns()
+    return dict((name, np.asarray(values, dtype=columns[name].dtype)) for name, values in rows.items())
+
+
+def fingerprint(path, offset):
+    '''Identifies a results file by its inode and its first bytes up to offset, which appending doesn't change'''
+
+    with open(path, 'rb') as fl:
+        head = fl.read(min(offset, FINGERPRINT_BYTES))
+    return '%s-%s' % (os.stat(path).st_ino, hashlib.sha1(head).hexdigest())
+
+
+def load_results(path):
+    '''Loads a results file, parsing only the lines appended since the cached columns were saved'''
+
+    cache_path = path + '.npz'
+    columns, sites, labels, offset = empty_columns(), [], [], 0
+
+    if os.path.exists(cache_path):
+        try:
+            cached = np.load(cache_path, allow_pickle=False)
+            if (int(cached['version']) == CACHE_VERSION and int(cached['offset']) <= os.path.getsize(path) and
+                    str(cached['fingerprint']) == fingerprint(path, int(cached['offset']))):
+                columns = dict((name, cached[name]) for name in columns)
+                sites = [site for site in cached['sites']]
+                labels = [label for label in cached['labels']]
+                offset = int(cached['offset'])
+        except (IOError, KeyError, ValueError) as e:
+            print("Ignoring unreadable cache %s: %s" % (cache_path, e))
+
+    with open(path, 'rb') as fl:
+        fl.seek(offset)
+        data = fl.read()
+
+    # Leave a partially written last line for the next run
+    end = data.rfind(b'\n') + 1
+    if end:
+        new_columns = parse_lines(data[:end].decode('utf-8').splitlines(), sites, labels)
+        columns = dict((name, np.concatenate([columns[name], new_columns[name]])) for name in columns)
+        offset += end
+
+        to_save = dict(columns)
+        to_save['sites'] = np.array(sites, dtype='U')
+        to_save['labels'] = np.array(labels, dtype='U')
+        to_save['offset'] = np.array(offset)
+        to_save['fingerprint'] = np.array(fingerprint(path, offset), dtype='U')
+        to_save['version'] = np.array(CACHE_VERSION)
+        try:
+            with open(cache_path, 'wb') as fl:
+                np.savez(fl, **to_save)
+        except IOError as e:
+            print("Unable to save cache %s: %s" % (cache_path, e))
+
+    return Results(columns, sites, labels)
+
+
+def merge_results(results_list):
+    '''Merges results of several files, re-coding their sites and labels into shared lists'''
+
+    sites, labels = [], []
+    site_codes, label_codes = {}, {}
+    merged = dict((name, []) for name in empty_columns())
+    for results in results_list:
+        for values, codes, strings in ((results.sites, site_codes, sites), (results.labels, label_codes, labels)):
+            for value in values:
+                if value not in codes:
+                    codes[value] = len(strings)
+                    strings.append(value)
+        site_map = np.array([site_codes[site] for site in results.sites] or [0], np.int32)
+        label_map = np.array([label_codes[label] for label in results.labels] or [0], np.int32)
+        for name in merged:
+            column = results.columns[name]
+            if name == 'site':
+                column = site_map[column]
+            elif name == 'label':
+                column = label_map[column]
+            merged[name].append(column)
+
+    columns = empty_columns()
+    for name in columns:
+        if merged[name]:
+            columns[name] = np.concatenate(merged[name]).astype(columns[name].dtype)
+    return Results(columns, sites, labels)
+
+
+def select(results, mask):
+    return Results(dict((name, column[mask]) for name, column in results.columns.items()),
+                   results.sites, results.labels)
+
+
+def grouped_percentiles(keys, values, percentiles):
+    '''
+    Percentiles of values for every distinct key, with the same linear interpolation as np.percentile.
+    Returns (unique keys, counts, array of shape (len(unique keys), len(percentiles))).
+    '''
+
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    unique_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+
+    result = np.empty((len(unique_keys), len(percentiles)))
+    for i, percentile in enumerate(percentiles):
+        position = starts + (counts - 1) * (percentile / 100.0)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        fraction = position - low
+        result[:, i] = values[low] * (1 - fraction) + values[high] * fraction
+    return unique_keys, counts, result
+
+
+def group_codes(results):
+    '''Combined mode and cache state code of every row, mode * len(CACHE_STATES) + cache state'''
+
+    return results.columns['mode'].astype(np.int64) * len(CACHE_STATES) + results.columns['cache_state']
+
+
+def group_name(code):
+    return '%s/%s' % (MODES[code // len(CACHE_STATES)], CACHE_STATES[code % len(CACHE_STATES)])
+
+
+def overall_table(results, metric):
+    values = results.columns[metric]
+    valid = np.isfinite(values)
+    groups, counts, table = grouped_percentiles(group_codes(results)[valid], values[valid], PERCENTILES)
+    return [(group_name(group), count, row) for group, count, row in zip(groups, counts, table)]
+
+
+def per_site_table(results, metric):
+    values = results.columns[metric]
+    valid = np.isfinite(values)
+    keys = group_codes(results) * len(results.sites) + results.columns['site']
+    keys, counts, table = grouped_percentiles(keys[valid], values[valid], PERCENTILES)
+    return [(results.sites[key % len(results.sites)], group_name(key // len(results.sites)), count, row)
+            for key, count, row in zip(keys, counts, table)]
+
+
+def site_speedups(results, metric, cache_state):
+    '''
+    Ratio of the chromiumlike median to the sparrow median for every site with results in both modes,
+    above 1 means sparrow is faster. Returns (site codes, ratios).
+    '''
+
+    values = results.columns[metric]
+    valid = np.isfinite(values) & (values > 0) & (results.columns['cache_state'] == CACHE_STATES.index(cache_state))
+    keys = results.columns['site'].astype(np.int64) * len(MODES) + results.columns['mode']
+    keys, counts, medians = grouped_percentiles(keys[valid], values[valid], [50])
+
+    median_by_mode = np.full((len(results.sites), len(MODES)), np.nan)
+    median_by_mode[keys // len(MODES), keys % len(MODES)] = medians[:, 0]
+    both = np.all(np.isfinite(median_by_mode), axis=1)
+    sites = np.nonzero(both)[0]
+    return sites, median_by_mode[both, MODES.index('chromiumlike')] / median_by_mode[both, MODES.index('sparrow')]
+
+
+def bootstrap_speedup(ratios, iterations=2000, confidence=95, seed=0):
+    '''
+    Geometric mean speedup over sites, with a bootstrap confidence interval from resampling the sites.
+    Returns (speedup, low, high).
+    '''
+
+    log_ratios = np.log(ratios)
+    random = np.random.RandomState(seed)
+    # Resample in chunks so the index matrix stays small with thousands of sites
+    means = []
+    chunk = max(1, min(iterations, 10 ** 7 // max(len(log_ratios), 1)))
+    for start in range(0, iterations, chunk):
+        size = min(chunk, iterations - start)
+        samples = random.randint(0, len(log_ratios), size=(size, len(log_ratios)))
+        means.append(log_ratios[samples].mean(axis=1))
+    means = np.concatenate(means)
+
+    tail = (100 - confidence) / 2.0
+    low, high = np.percentile(means, [tail, 100 - tail])
+    return np.exp(log_ratios.mean()), np.exp(low), np.exp(high)
+
+
+def format_row(name, count, row):
+    return '  %-28s %8d  ' % (name, count) + '  '.join('%9.3f' % value for value in row)
+
+
+def report(results, per_site=False, iterations=2000):
+    header = '  %-28s %8s  ' % ('', 'count') + '  '.join('%9s' % ('p%s' % p) for p in PERCENTILES)
+    errors = int(results.columns['error'].sum())
+    print("%s results, %s sites, %s errors" % (len(results), len(results.sites), errors))
+
+    for metric in METRICS:
+        table = overall_table(results, metric)
+        if not table:
+            continue
+        print("\n%s (s)" % metric)
+        print(header)
+        for name, count, row in table:
+            print(format_row(name, count, row))
+
+        if per_site:
+            for site, name, count, row in per_site_table(results, metric):
+                print(format_row('%s %s' % (name, site), count, row))
+
+    for metric in ('load_time', 'browser_load_time'):
+        for cache_state in CACHE_STATES:
+            sites, ratios = site_speedups(results, metric, cache_state)
+            if not len(ratios):
+                continue
+            speedup, low, high = bootstrap_speedup(ratios, iterations=iterations)
+            print("\nsparrow speedup, %s %s: %.3fx (95%% CI %.3fx - %.3fx) over %s sites"
+                  % (cache_state, metric, speedup, low, high, len(ratios)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='drive.py report')
+    parser.add_argument('results_files', nargs='+', help='results files written by drive.py')
+    parser.add_argument('-l', '--label', help='only use results whose test label contains this string')
+    parser.add_argument('--per-site', action='store_true', help='also print percentiles for every site')
+    parser.add_argument('--bootstrap', type=int, default=2000, help='number of bootstrap resamples')
+    args = parser.parse_args(argv)
+
+    results = merge_results([load_results(path) for path in args.results_files])
+    if args.label:
+        matching = np.array([args.label in label for label in results.labels] or [False])
+        results = select(results, matching[results.columns['label']])
+
+    if not len(results):
+        print("No results found")
+        return 1
+
+    report(results, per_site=args.per_site, iterations=args.bootstrap)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+'''
+Append-only store for per-site measurements.
+
+Each record is written as one line of JSON. Records are handed to a background thread which writes them in batches,
+so the drive loop never waits on the disk, and any number of sessions can add records at the same time.
+'''
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+
+
+class ResultsStore(object):
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0, fsync=False):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.queue = Queue.Queue()
+        self.fl = None
+
+        self.writer = threading.Thread(target=self.write_records, name='results-store')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def add(self, record):
+        '''Queues a record for writing, never blocks'''
+
+        self.queue.put(record)
+
+    def close(self):
+        '''Writes out everything queued so far and stops the writer'''
+
+        self.queue.put(None)
+        self.writer.join()
+
+    def write_records(self):
+        done = False
+        while not done:
+            batch = []
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(deadline - time.time(), 0.01))
+                except Queue.Empty:
+                    break
+                if record is None:
+                    done = True
+                    break
+                batch.append(record)
+
+            if not batch:
+                continue
+
+            try:
+                self.write_batch(batch)
+            except (IOError, OSError, TypeError, ValueError) as e:
+                logging.exception("Unable to write %s results to %s" % (len(batch), self.path))
+
+        self.finish()
+
+    def write_batch(self, batch):
+        if self.fl is None:
+            self.fl = open(self.path, 'a')
+        self.fl.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in batch))
+        self.fl.flush()
+        if self.fsync:
+            os.fsync(self.fl.fileno())
+
+    def finish(self):
+        if self.fl is not None:
+            self.fl.close()
+
+
+class CompressedStore(ResultsStore):
+    '''
+    Writes records to gzipped JSON lines files in a directory, <key_of(record)>.jsonl.gz. Every batch is appended as
+    a gzip member of its own, so a crash loses at most the batch being written.
+    '''
+
+    def __init__(self, directory, key_of, **kwargs):
+        self.key_of = key_of
+        ResultsStore.__init__(self, directory, **kwargs)
+
+    def file_name(self, key):
+        return os.path.join(self.path, key.replace('/', '_') + '.jsonl.gz')
+
+    def write_batch(self, batch):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        files = {}
+        for record in batch:
+            files.setdefault(self.file_name(self.key_of(record)), []).append(record)
+        for path, records in files.items():
+            with gzip.open(path, 'ab') as fl:
+                fl.write(''.join(json.dumps(record, sort_keys=True) + '\n' for record in records))
+
+
+def read_results(path):
+    '''Yields the records of a results file, gzipped or not, skipping a partially written last line'''
+
+    with (gzip.open(path) if path.endswith('.gz') else open(path)) as fl:
+        try:
+            for line in fl:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except (IOError, EOFError):
+            # The last gzip member was cut short
+            return
@@ -0,0 +1,122 @@
+'''
+Writes screenshots from a background thread, so the drive loop only pays for the capture itself.
+
+  screenshots = ScreenshotStore('./screenshots', max_width=640)
+  screenshots.add(remote.get_screenshot_as_base64(), site, '00003-sparrow-cold')
+  screenshots.close()
+
+Screenshots go to <directory>/<pass>/<site>.png. The queue is bounded, when the writer falls behind screenshots are
+dropped rather than holding up the drive loop. A screenshot that looks the same as the last one written for the site
+and mode is skipped: with PIL installed by comparing difference hashes, so re-encoding noise and tiny changes don't
+count, without it only byte identical images are skipped, and max_width downscaling is not available.
+'''
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+import Queue
+from cStringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+QUEUE_SIZE = 32
+
+# Difference hashes at most this many bits apart are the same picture
+HASH_DISTANCE = 4
+
+
+def difference_hash(image, size=8):
+    '''64 bit hash of which neighbouring pixels get brighter, of a size+1 x size greyscale thumbnail'''
+
+    pixels = list(image.convert('L').resize((size + 1, size), Image.BILINEAR).getdata())
+    value = 0
+    for row in range(size):
+        for column in range(size):
+            left = pixels[row * (size + 1) + column]
+            value = value << 1 | (pixels[row * (size + 1) + column + 1] > left)
+    return value
+
+
+def site_file_name(site):
+    return site.replace(':', '_').replace('/', '_') + '.png'
+
+
+class ScreenshotStore(object):
+
+    def __init__(self, directory, max_width=None, dedupe=True, queue_size=QUEUE_SIZE):
+        self.directory = directory
+        self.max_width = max_width
+        self.dedupe = dedupe
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        # (site, mode) -> hash of the last screenshot written
+        self.last_hashes = {}
+
+        if max_width and Image is None:
+            logging.warning("PIL is not installed, screenshots will not be downscaled")
+
+        self.writer = threading.Thread(target=self.write_screenshots, name='screenshot-store')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def add(self, png_base64, site, pass_name, mode=None):
+        '''Queues a screenshot as returned by get_screenshot_as_base64, never blocks'''
+
+        try:
+            self.queue.put_nowait((png_base64, site, pass_name, mode))
+        except Queue.Full:
+            self.dropped += 1
+            logging.warning("Screenshot writer is behind, dropped screenshot of %s (%s so far)" % (site, self.dropped))
+
+    def close(self):
+        '''Writes out everything queued so far and stops the writer'''
+
+        self.queue.put(None)
+        self.writer.join()
+
+    def write_screenshots(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.write(*item)
+            except Exception as e:
+                logging.exception("Exception caught writing screenshot of %s" % item[1])
+
+    def write(self, png_base64, site, pass_name, mode):
+        png = base64.b64decode(png_base64)
+
+        image = None
+        if Image is not None and (self.max_width or self.dedupe):
+            image = Image.open(StringIO(png))
+
+        if self.dedupe:
+            if image is not None:
+                image_hash = difference_hash(image)
+                last = self.last_hashes.get((site, mode))
+                same = last is not None and bin(last ^ image_hash).count('1') <= HASH_DISTANCE
+            else:
+                image_hash = hashlib.sha1(png).hexdigest()
+                same = self.last_hashes.get((site, mode)) == image_hash
+            if same:
+                logging.debug("Screenshot of %s unchanged, not saving it" % site)
+                return
+            self.last_hashes[(site, mode)] = image_hash
+
+        directory = os.path.join(self.directory, pass_name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, site_file_name(site))
+
+        if image is not None and self.max_width and image.size[0] > self.max_width:
+            image.thumbnail((self.max_width, image.size[1] * self.max_width // image.size[0]), Image.ANTIALIAS)
+            image.save(path, 'PNG', optimize=True)
+        else:
+            with open(path, 'wb') as fl:
+                fl.write(png)
@@ -27,14 +27,167 @@ from selenium.webdriver.common.action_chains import ActionChains
 import subprocess
 from subprocess import CalledProcessError
 
+from spans import NULL_TRACER, clock
+from waits import wait_until, stable_value, network_idle
+
 WEBDRIVER_LOC = {'windows': 'C:\\chromedriver\\chromedriver.exe',
                  'mac': '',
                  'linux': ''}
 
 # Used to drive sparrow with 'on hover' when indicated in the feature file
 HYPERLINK_TEMPLATE_URL = "http://bizzbyster.github.io/sitelists/hyperlink_template.html"
+# Seconds the mouse rests on the link before the click, the time sparrow gets to act on the hover
 HOVER_TIME = 0.5
 
+# Seconds fast.com gets to finish its speed test, done early once the speed shows as final or stops changing
+FAST_COM_TIMEOUT = 20
+FAST_COM_STABLE = 3
+
+# Seconds to wait for the network of the warm profile priming page to go idle
+PRIME_IDLE_TIMEOUT = 20
+
+# Seconds between reloads of sparrow://beerstatus when polling for the beer ack, each one is a navigation in the
+# measured browser. The loaded page is read every ACK_POLL_INTERVAL seconds in between.
+ACK_RELOAD_INTERVAL = 1
+ACK_POLL_INTERVAL = 0.25
+
+# Seconds an async script may run before webdriver gives up on it
+SCRIPT_TIMEOUT = 30
+
+# Seconds collect_navigation_timing waits for the load event of a page that is still loading
+NAVIGATION_TIMING_WAIT = 20
+
+# Seconds a beer ack observer watches sparrow://beerstatus before the page is reloaded
+ACK_OBSERVE_WINDOW = 1
+
+# Console log entries kept per site visit, and characters kept per message
+BROWSER_LOG_MAX_ENTRIES = 200
+BROWSER_LOG_MAX_MESSAGE = 1000
+# Seconds chromedriver gets to hand over the browser log
+BROWSER_LOG_TIMEOUT = 5
+
+# Speed shown by fast.com and whether it is the final result
+FAST_COM_RESULT_SCRIPT = '''
+var value = document.getElementById('speed-value');
+if (!value) return null;
+return {'speed': value.textContent, 'done': value.className.indexOf('succeeded') >= 0};
+'''
+
+# Resolves with the Navigation Timing (level 2 if available, else level 1 relative to navigationStart) and paint
+# timings of the page, once its load event is done or after arguments[0] milliseconds.
+NAVIGATION_TIMING_SCRIPT = '''
+var wait_ms = arguments[0];
+var done = arguments[arguments.length - 1];
+
+function collect() {
+    var timing = {};
+    var navigation = performance.getEntriesByType ? performance.getEntriesByType('navigation')[0] : null;
+    if (navigation) {
+        var entry = navigation.toJSON();
+        for (var key in entry) {
+            if (typeof entry[key] === 'number' || typeof entry[key] === 'string') {
+                timing[key] = entry[key];
+            }
+        }
+    } else {
+        var legacy = performance.timing;
+        for (var key in legacy) {
+            if (typeof legacy[key] === 'number') {
+                timing[key] = legacy[key] ? legacy[key] - legacy.navigationStart : 0;
+            }
+        }
+        timing['startTime'] = 0;
+        timing['loadEventEnd'] = timing['loadEventEnd'] || 0;
+    }
+
+    var paint = {};
+    var paints = performance.getEntriesByType ? performance.getEntriesByType('paint') : [];
+    for (var i = 0; i < paints.length; i++) {
+        paint[paints[i].name] = paints[i].startTime;
+    }
+    done({url: location.href, navigation: timing, paint: paint});
+}
+
+if (document.readyState === 'complete') {
+    collect();
+} else {
+    var timer = setTimeout(collect, wait_ms);
+    window.addEventListener('load', function() {
+        clearTimeout(timer);
+        // loadEventEnd is only set once the load handlers have returned
+        setTimeout(collect, 0);
+    });
+}
+'''
+
+# Turns the 'key: value' lines of a sparrow://beerstatus table entry into an object
+BEER_ENTRY_PARSER = '''
+function parseEntry(text) {
+    var entry = {};
+    text.split('\\n').forEach(function(line) {
+        var index = line.indexOf(':');
+        if (index >= 0) {
+            entry[line.slice(0, index)] = line.slice(index + 1).trim();
+        }
+    });
+    return entry;
+}
+'''
+
+# Returns every sparrow://beerstatus table entry as an object, in table order
+READ_BEER_STATUS_SCRIPT = BEER_ENTRY_PARSER + '''
+var components = document.getElementsByClassName('component');
+var entries = [];
+for (var i = 0; i < components.length; i++) {
+    entries.push(parseEntry(components[i].innerText));
+}
+return entries;
+'''
+
+# Resolves with the sparrow://beerstatus entry that acks arguments[0] with a GUID other than arguments[1],
+# or null when no such entry appears within arguments[2] milliseconds.  Same rules as BeerStatusIndex.check_ack.
+WAIT_FOR_BEER_ACK_SCRIPT = BEER_ENTRY_PARSER + '''
+var url = arguments[0], lastGuid = arguments[1], window_ms = arguments[2];
+var done = arguments[arguments.length - 1];
+
+function findAck() {
+    var components = document.getElementsByClassName('component');
+    for (var i = 0; i < components.length; i++) {
+        var entry = parseEntry(components[i].innerText);
+        if (entry['BEER for url'] !== url) {
+            continue;
+        }
+        if (entry['Acked'] === '-1' || entry['Acked'] === '0') {
+            return entry;
+        }
+        if (entry['Acked'] === '1' && entry['GUID'] !== lastGuid) {
+            return entry;
+        }
+    }
+    return null;
+}
+
+var found = findAck();
+if (found) {
+    done(found);
+} else {
+    var observer, timer;
+    var finish = function(entry) {
+        observer.disconnect();
+        clearTimeout(timer);
+        done(entry);
+    };
+    observer = new MutationObserver(function() {
+        var entry = findAck();
+        if (entry) {
+            finish(entry);
+        }
+    });
+    timer = setTimeout(function() { finish(null); }, window_ms);
+    observer.observe(document.body, {childList: true, subtree: true, characterData: true});
+}
+'''
+
 def initializeCpes(context, browser_name):
     context.common.cpeInit(browser_name)
     return True
@@ -181,7 +334,7 @@ def runSelenium(context, browser_name, browser_dict, cpeLocation, cmdSwitches, o
         # Initialize new user data dir
         remote, beerstatus_tab, content_tab = start_remote(cpeLocation, driver_options, sparrow_controller)
         load_url("http://www.google.com", remote)
-        time.sleep(20)
+        wait_until(network_idle(remote), timeout=PRIME_IDLE_TIMEOUT)
         try:
             remote.quit()
         except Exception as e:
@@ -236,18 +389,10 @@ def runSelenium(context, browser_name, browser_dict, cpeLocation, cmdSwitches, o
                     site_count += 1
 
                     remote.switch_to_window(beerstatus_tab)
-                    # Wait up to 20 seconds for beer ack
-                    num_tries = 20
-                    trys = 0
-                    for i in range(num_tries):
-                        load_url("sparrow://beerstatus/", remote)
-                        if check_beer_status(site, beer_status_dict, remote):
-                            break
-
-                        trys += 1
-                        time.sleep(1)
 
-                    if trys == num_tries:
+                    # Wait up to 20 seconds for beer ack
+                    if not wait_until(beer_ack_received(site, beer_status_dict, remote), timeout=20,
+                                      interval=ACK_POLL_INTERVAL):
                         logging.info("No beer ack recieved for %s" % site)
 
                 except Exception as e:
@@ -274,34 +419,67 @@ def runSelenium(context, browser_name, browser_dict, cpeLocation, cmdSwitches, o
 
     return True
 
-def load_on_hover(url, remote, speed_value=None):
-    # Add download speed to the hyperlink url for later analysis
-    hyperlink = HYPERLINK_TEMPLATE_URL + '?speed_test=%s' % speed_value  if speed_value else HYPERLINK_TEMPLATE_URL
-
-    remote.get(hyperlink)
+def load_on_hover(url, remote, speed_value=None, tracer=NULL_TRACER, record=None, template=None,
+                  hover_time=HOVER_TIME):
+    '''
+    Hovers over then clicks a link to url. With a template (see local_server) the template page is served with the
+    link already in place, otherwise the link is injected into HYPERLINK_TEMPLATE_URL.
+    '''
     click_text = "Click Me Please"
-    element = remote.find_element_by_id("put_hyperlink_here")
-    remote.execute_script(
-      "arguments[0].innerHTML = '<a href=\"" + url + "\">" + click_text + "</a>';", element)
-    link_element = remote.find_element_by_link_text(click_text)
-    actions = ActionChains(remote)
-    actions.move_to_element(link_element)
-    actions.perform()
-    time.sleep(HOVER_TIME)
-    actions.click(link_element)
-    actions.perform()
 
-def load_url(url, remote):
+    if template is not None:
+        with tracer.span('template', record=record):
+            remote.get(template.template_url(url, click_text, speed_value))
+        with tracer.span('find_link', record=record):
+            link_element = remote.find_element_by_link_text(click_text)
+    else:
+        # Add download speed to the hyperlink url for later analysis
+        hyperlink = HYPERLINK_TEMPLATE_URL + '?speed_test=%s' % speed_value  if speed_value else HYPERLINK_TEMPLATE_URL
+
+        with tracer.span('template', record=record):
+            remote.get(hyperlink)
+        with tracer.span('inject_link', record=record):
+            element = remote.find_element_by_id("put_hyperlink_here")
+            remote.execute_script(
+              "arguments[0].innerHTML = '<a href=\"" + url + "\">" + click_text + "</a>';", element)
+            link_element = remote.find_element_by_link_text(click_text)
+    actions = ActionChains(remote)
+    with tracer.span('hover', record=record):
+        actions.move_to_element(link_element)
+        actions.perform()
+    with tracer.span('hover_sleep', record=record):
+        time.sleep(hover_time)
+    with tracer.span('click', record=record):
+        actions.click(link_element)
+        actions.perform()
+
+def load_url(url, remote, tracer=NULL_TRACER, record=None, stats=None):
     try:
-        remote.get(url)
+        with tracer.span('load_url', record=record):
+            remote.get(url)
         if url == 'https://fast.com/':
-            time.sleep(20)
+            wait_until(fast_com_done(remote), timeout=FAST_COM_TIMEOUT, interval=0.5, replaces=FAST_COM_TIMEOUT,
+                       stats=stats, tracer=tracer, name='fast_com', record=record)
 
     except TimeoutException as e:
         logging.exception("Selenium exception caught.")
 
     return
 
+def fast_com_done(remote):
+    '''Condition that holds once fast.com marks its speed as final, or the speed has stopped changing'''
+
+    state = {}
+
+    def read_speed():
+        result = remote.execute_script(FAST_COM_RESULT_SCRIPT) or {}
+        state['done'] = result.get('done')
+        speed = result.get('speed')
+        return speed if speed and speed.strip() != '0' else None
+
+    speed_stable = stable_value(read_speed, FAST_COM_STABLE)
+    return lambda: speed_stable() or state['done']
+
 def load_url_and_crash(url, remote):
 
     try:
@@ -314,11 +492,51 @@ def load_url_and_crash(url, remote):
 
     return True
 
+def collect_navigation_timing(remote):
+    '''Returns the browser measured navigation and paint timings of the page in the current tab, in milliseconds'''
+
+    return remote.execute_async_script(NAVIGATION_TIMING_SCRIPT, NAVIGATION_TIMING_WAIT * 1000)
+
+def drain_browser_log(remote, max_entries=BROWSER_LOG_MAX_ENTRIES, max_message=BROWSER_LOG_MAX_MESSAGE,
+                      timeout=BROWSER_LOG_TIMEOUT):
+    '''
+    Takes everything logged to the console since the last call, in one round trip of at most timeout seconds.
+    Returns (counts by level, the first max_entries entries with messages cut to max_message characters, number of
+    entries left out).
+    '''
+
+    # Every session has a command executor of its own, so the timeout only applies to this call. chromedriver
+    # empties its buffer even when we stop waiting for the answer.
+    executor = remote.command_executor
+    executor._timeout = timeout
+    try:
+        entries = remote.get_log('browser')
+    finally:
+        del executor._timeout
+    counts = {}
+    for entry in entries:
+        counts[entry.get('level')] = counts.get(entry.get('level'), 0) + 1
+
+    kept = [dict(entry, message=entry.get('message', '')[:max_message]) for entry in entries[:max_entries]]
+    return counts, kept, max(0, len(entries) - max_entries)
+
+def set_network_conditions(remote, latency_ms, download_mbps, upload_mbps):
+    '''Emulates a slower link in every tab of the session, on top of the real one'''
+
+    # Only webdriver.Chrome registers chromedriver's network conditions endpoint, webdriver.Remote needs to be told
+    remote.command_executor._commands.setdefault('setNetworkConditions',
+                                                 ('POST', '/session/$sessionId/chromium/network_conditions'))
+    remote.execute('setNetworkConditions', {'network_conditions': {
+        'offline': False,
+        'latency': latency_ms,
+        'download_throughput': int(download_mbps * 1000000 / 8),
+        'upload_throughput': int(upload_mbps * 1000000 / 8)}})
+
 def extract_value_from_page(remote, element_id):
     element = remote.find_element_by_id(element_id)
     return element.text
 
-def start_remote(cpe_location, driver_options, sparrow_controller=None):
+def start_remote(cpe_location, driver_options, sparrow_controller=None, restart_sparrow=True):
 
     numtries = 1
     for i in range(10):
@@ -332,6 +550,7 @@ def start_remote(cpe_location, driver_options, sparrow_controller=None):
 
             remote.switch_to_window(beerstatus_tab)
             remote.get("sparrow://beerstatus/")
+            remote.set_script_timeout(SCRIPT_TIMEOUT)
             break
 
         except Exception as e:
@@ -340,42 +559,97 @@ def start_remote(cpe_location, driver_options, sparrow_controller=None):
             numtries += 1
             if sparrow_controller is not None:
                 sparrow_controller.stopSparrow()
-            else:
-                # Running with drive.py locally on a cpe
-                stop_sparrow()
+            elif restart_sparrow:
+                # Running with drive.py locally on a cpe, the browser may be a build with another name
+                stop_sparrow(os.path.basename(driver_options.binary_location or 'sparrow'))
 
             continue
 
     return remote, beerstatus_tab, content_tab
 
-def stop_sparrow():
+def replace_content_tab(remote, beerstatus_tab, content_tab):
+    '''Closes a hung content tab and opens a fresh one in the same session, returns the new content tab'''
+
+    remote.switch_to_window(beerstatus_tab)
+    old_tabs = set(remote.window_handles)
+    remote.execute_script("window.open('about:blank', '_blank');")
+    new_tab = [tab for tab in remote.window_handles if tab not in old_tabs][0]
+
+    remote.switch_to_window(content_tab)
+    remote.close()
+    remote.switch_to_window(beerstatus_tab)
+
+    return new_tab
+
+def stop_sparrow(process_name='sparrow'):
     if "darwin" in sys.platform:
         cmd = ["pkill", "-9", "Sparrow"]
 
+    elif sys.platform.startswith("linux"):
+        # Only the browsers in our own process group, other drive instances on the same server keep running.
+        # Process names are truncated to 15 characters.
+        cmd = ["pkill", "-9", "-g", str(os.getpgrp()), "-x", process_name[:15]]
+
     elif "win" in sys.platform:
         cmd = ["taskkill", "/IM", "Sparrow.exe", "/F"]
 
     # Best effort, not checking return
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-def check_beer_status(url, beer_status_dict, remote):
+def wait_for_beer_ack(url, beer_status_dict, remote, timeout):
+    '''
+    Watches the sparrow://beerstatus page loaded in the current tab for a new beer ack of url and returns as soon
+    as it shows up. The page is only reloaded if nothing showed up for ACK_OBSERVE_WINDOW seconds.
+    Returns False if no ack was seen within timeout seconds.
+    '''
 
-    try:
-        beer_entries = remote.find_elements_by_class_name("component")
-    except Exception as e:
-        logging.exception("Exception caught during remote.find_elements_by_class_name.")
-        return False
+    deadline = time.time() + timeout
+    reload_page = False
+    while time.time() < deadline:
+        try:
+            if reload_page:
+                remote.get("sparrow://beerstatus")
+            window = min(ACK_OBSERVE_WINDOW, max(deadline - time.time(), 0))
+            beer_dict = remote.execute_async_script(WAIT_FOR_BEER_ACK_SCRIPT, url, beer_status_dict.get(url),
+                                                    int(window * 1000))
+        except TimeoutException:
+            logging.exception("Timed out watching sparrow://beerstatus.")
+            beer_dict = None
+
+        reload_page = True
+        if not beer_dict:
+            continue
+
+        acked = beer_dict.get('Acked')
+        if acked == '-1':
+            logging.info("Beer Ack is misconfigured, will not check for Ack.")
+        elif acked == '0':
+            logging.info("Sparrow did not receive beer ack for %s" % url)
+        else:
+            beer_status_dict[url] = beer_dict['GUID']
+        return True
+
+    return False
 
-    # Examine each entry in the table.
-    for beer in beer_entries:
-        text = str(beer.text)
-        if url in text:
-            beer_dict = {}
-            # Make dictionary out of the table entry
-            for line in text.split('\n'):
-                entry = line.split(':', 1)
-                beer_dict[entry[0]] = entry[1].strip()
+class BeerStatusIndex(object):
+    '''The sparrow://beerstatus table entries, indexed by url'''
 
+    def __init__(self, entries):
+        self.entries = entries
+        self.by_url = {}
+        for entry in entries:
+            self.by_url.setdefault(entry.get('BEER for url'), []).append(entry)
+
+    def entries_for(self, url):
+        return self.by_url.get(url, [])
+
+    def check_ack(self, url, beer_status_dict):
+        '''
+        Returns True if the beer for url has been acked with a GUID we have not seen yet, recording it in
+        beer_status_dict, or if the table shows that no ack is coming for url.
+        '''
+
+        for beer_dict in self.entries_for(url):
             acked = beer_dict.get('Acked')
             if acked == '-1':
                 logging.info("Beer Ack is misconfigured, will not check for Ack.")
@@ -383,16 +657,42 @@ def check_beer_status(url, beer_status_dict, remote):
             elif acked == '0':
                 logging.info("Sparrow did not receive beer ack for %s" % url)
                 return True
-            elif (acked == '1' and
-                  beer_dict.get('BEER for url') == url and
-                  beer_dict.get('GUID') != beer_status_dict[url]):
-
+            elif acked == '1' and beer_dict.get('GUID') != beer_status_dict[url]:
                 beer_status_dict[url] = beer_dict['GUID']
                 return True
 
-        else:
-            # Not the entry we are looking for.
-            continue
+        return False
 
-    return False
+def beer_ack_received(url, beer_status_dict, remote, tracer=NULL_TRACER, record=None):
+    '''
+    Condition for wait_until that holds once the beer for url is acked. sparrow://beerstatus is reloaded at most
+    every ACK_RELOAD_INTERVAL seconds, and only read in between.
+    '''
+
+    state = {'reloaded': None}
+
+    def condition():
+        now = clock()
+        if state['reloaded'] is None or now - state['reloaded'] >= ACK_RELOAD_INTERVAL:
+            with tracer.span('ack_reload', record=record):
+                remote.get("sparrow://beerstatus")
+            state['reloaded'] = now
+        with tracer.span('ack_check', record=record):
+            return check_beer_status(url, beer_status_dict, remote)
+
+    return condition
+
+def read_beer_status(remote):
+    '''Reads all entries of the sparrow://beerstatus page loaded in the current tab with a single script call'''
+
+    return BeerStatusIndex(remote.execute_script(READ_BEER_STATUS_SCRIPT) or [])
+
+def check_beer_status(url, beer_status_dict, remote):
+
+    try:
+        beer_status = read_beer_status(remote)
+    except Exception as e:
+        logging.exception("Exception caught reading sparrow://beerstatus.")
+        return False
 
+    return beer_status.check_ack(url, beer_status_dict)
@@ -0,0 +1,97 @@
+'''
+Sequential test of sparrow against chromiumlike load times for one site, fed one paired visit at a time.
+
+Each pair adds d = log(chromiumlike time / sparrow time), so d > 0 means sparrow was faster. After every pair the
+mixture sequential probability ratio test (mSPRT) of H0: mean(d) = 0 is updated, with a N(0, tau^2) mixture over the
+alternatives and the sample variance of d plugged in. Its p-value stays valid however often it is looked at, so the
+site can be retired the moment it drops below alpha instead of after a fixed number of visits.
+
+  test = PairedSequentialTest()
+  test.add(sparrow_time, chromiumlike_time)  # None for a visit that failed
+  if test.decided(): ...
+'''
+
+import math
+
+ALPHA = 0.05
+
+# Standard deviation of the log speedups the test is tuned to detect, 0.1 is about a 10% speedup
+TAU = 0.1
+
+# Pairs needed before the variance estimate is trusted, fewer lets the false positive rate creep over alpha
+MIN_PAIRS = 10
+
+# Pairs after which an undecided site is retired as inconclusive, failed pairs included
+MAX_PAIRS = 50
+
+# Failed pairs in a row after which a site is retired with an error, e.g. a site that always times out
+MAX_FAILED_PAIRS = 5
+
+
+class PairedSequentialTest(object):
+
+    def __init__(self, alpha=ALPHA, tau=TAU, min_pairs=MIN_PAIRS, max_pairs=MAX_PAIRS,
+                 max_failed_pairs=MAX_FAILED_PAIRS):
+        self.alpha = alpha
+        self.tau = tau
+        self.min_pairs = min_pairs
+        self.max_pairs = max_pairs
+        self.max_failed_pairs = max_failed_pairs
+        self.pairs = 0
+        # Pairs where either visit had no time, in total and since the last complete pair
+        self.failed_pairs = 0
+        self.consecutive_failures = 0
+        self.total = 0.0
+        self.total_squares = 0.0
+        # Running minimum of 1 / likelihood ratio, the always valid p-value
+        self.p_value = 1.0
+
+    def add(self, sparrow_time, chromiumlike_time):
+        if sparrow_time is None or chromiumlike_time is None or sparrow_time <= 0 or chromiumlike_time <= 0:
+            self.failed_pairs += 1
+            self.consecutive_failures += 1
+            return
+        d = math.log(chromiumlike_time / float(sparrow_time))
+        self.consecutive_failures = 0
+        self.pairs += 1
+        self.total += d
+        self.total_squares += d * d
+        if self.pairs >= self.min_pairs:
+            self.p_value = min(self.p_value, 1.0 / self.likelihood_ratio())
+
+    def mean(self):
+        return self.total / self.pairs if self.pairs else 0.0
+
+    def variance(self):
+        if self.pairs < 2:
+            return 0.0
+        return max(0.0, (self.total_squares - self.pairs * self.mean() ** 2) / (self.pairs - 1))
+
+    def likelihood_ratio(self):
+        n = self.pairs
+        variance = max(self.variance(), 1e-6)
+        tau2 = self.tau ** 2
+        exponent = n * n * tau2 * self.mean() ** 2 / (2 * variance * (variance + n * tau2))
+        # The ratio only matters up to 1 / alpha, cap the exponent instead of overflowing
+        return math.sqrt(variance / (variance + n * tau2)) * math.exp(min(exponent, 700))
+
+    def significant(self):
+        return self.p_value <= self.alpha
+
+    def failed(self):
+        return self.consecutive_failures >= self.max_failed_pairs
+
+    def decided(self):
+        return self.significant() or self.failed() or self.pairs + self.failed_pairs >= self.max_pairs
+
+    def speedup(self):
+        '''chromiumlike time / sparrow time, geometric mean over the pairs so far'''
+
+        return math.exp(self.mean())
+
+    def verdict(self):
+        if self.significant():
+            return 'sparrow faster' if self.mean() > 0 else 'sparrow slower'
+        if self.failed():
+            return 'error'
+        return 'inconclusive' if self.pairs + self.failed_pairs >= self.max_pairs else 'undecided'
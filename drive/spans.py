@@ -0,0 +1,158 @@
+'''
+Lightweight timing spans for the phases of a site visit.
+
+  tracer = Tracer([LogExporter(), HistogramExporter()])
+  with tracer.span('template', record=record):
+      remote.get(HYPERLINK_TEMPLATE_URL)
+
+Spans are timed with a monotonic clock and handed to every exporter when they end. A span opened with record=<the
+result record of the site> is also added to that record by RecordExporter, so it ends up in the results store.
+'''
+
+import ctypes
+import ctypes.util
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+def monotonic_clock():
+    '''Returns a function giving monotonic seconds, python 2 has no time.monotonic'''
+
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if sys.platform.startswith('win'):
+        # time.clock is QueryPerformanceCounter on windows
+        return time.clock
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        logging.warning("No monotonic clock available, timing spans with time.time")
+        return time.time
+
+    clock_id = 6 if 'darwin' in sys.platform else 1   # CLOCK_MONOTONIC
+
+    def monotonic():
+        now = timespec()
+        clock_gettime(clock_id, ctypes.byref(now))
+        return now.tv_sec + now.tv_nsec * 1e-9
+
+    return monotonic
+
+clock = monotonic_clock()
+
+
+class Span(object):
+
+    def __init__(self, name, start, duration, record, attributes):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.record = record
+        self.attributes = attributes
+
+
+class Tracer(object):
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+
+    @contextmanager
+    def span(self, name, record=None, **attributes):
+        start = clock()
+        try:
+            yield
+        finally:
+            span = Span(name, start, clock() - start, record, attributes)
+            for exporter in self.exporters:
+                exporter.export(span)
+
+
+# Used when no tracer is passed in
+NULL_TRACER = Tracer()
+
+
+class RecordExporter(object):
+    '''Adds the duration of each span to the 'spans' of its result record, summing repeated phases'''
+
+    def export(self, span):
+        if span.record is not None:
+            spans = span.record.setdefault('spans', {})
+            spans[span.name] = spans.get(span.name, 0) + span.duration
+
+
+class LogExporter(object):
+
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def export(self, span):
+        site = span.record.get('site') if span.record is not None else ''
+        logging.log(self.level, "span %s %.1fms %s" % (span.name, span.duration * 1000, site))
+
+
+class HistogramExporter(object):
+    '''Keeps a histogram of span durations per phase in memory, in power of two buckets from 0.1ms up'''
+
+    BASE = 0.0001
+    BUCKETS = 24
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.totals = {}
+
+    def bucket(self, duration):
+        bucket = 0
+        limit = self.BASE
+        while duration > limit and bucket < self.BUCKETS - 1:
+            limit *= 2
+            bucket += 1
+        return bucket
+
+    def export(self, span):
+        bucket = self.bucket(span.duration)
+        with self.lock:
+            histogram = self.histograms.setdefault(span.name, [0] * self.BUCKETS)
+            histogram[bucket] += 1
+            self.totals[span.name] = self.totals.get(span.name, 0) + span.duration
+
+    def percentile(self, name, percentile):
+        '''Upper bound of the bucket holding the percentile, in seconds'''
+
+        histogram = self.histograms[name]
+        target = sum(histogram) * percentile / 100.0
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if count and seen >= target:
+                return self.BASE * 2 ** bucket
+        return self.BASE * 2 ** (self.BUCKETS - 1)
+
+    def summary(self):
+        '''Returns {phase: (count, total seconds, p50, p95)}'''
+
+        with self.lock:
+            return dict((name, (sum(histogram), self.totals[name], self.percentile(name, 50),
+                                self.percentile(name, 95)))
+                        for name, histogram in self.histograms.items())
+
+    def log_summary(self):
+        for name, (count, total, p50, p95) in sorted(self.summary().items(), key=lambda item: -item[1][1]):
+            logging.info("span %s: %s calls, %.2fs total, p50 <= %.1fms, p95 <= %.1fms" % (name, count, total,
+                                                                                          p50 * 1000, p95 * 1000))
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.totals = {}
+
+
+EXPORTERS = {'results': RecordExporter, 'log': LogExporter, 'histogram': HistogramExporter}
@@ -0,0 +1,83 @@
+'''
+Waiting on explicit conditions instead of fixed sleeps.
+
+  price = wait_until(stable_value(read_price, stable_for=2), timeout=20)
+
+wait_until polls a condition until it returns a true value, or gives up after its timeout and returns None. When the
+wait stands in for a fixed sleep, pass replaces=<seconds of that sleep> and stats=<a stats dict> and the time saved
+is added to stats['wait_saved'].
+'''
+
+import os
+import time
+
+from spans import NULL_TRACER, clock
+
+POLL_INTERVAL = 0.1
+
+# Removed by the browser when it has shut down and written out its profile: SingletonLock on mac and linux, lockfile
+# on windows
+PROFILE_LOCK_FILES = ('SingletonLock', 'lockfile')
+
+# Number of resources the page has loaded, -1 until the load event
+RESOURCE_COUNT_SCRIPT = '''
+return document.readyState == 'complete' ? performance.getEntriesByType('resource').length : -1;
+'''
+
+
+def wait_until(condition, timeout, interval=POLL_INTERVAL, replaces=None, stats=None, tracer=NULL_TRACER,
+               name='wait', record=None):
+    '''
+    Calls condition every interval seconds until it returns a true value, which is returned, or until timeout
+    seconds have passed, then returns None. replaces is the fixed sleep this wait stands in for, in seconds or as a
+    function of the seconds waited.
+    '''
+
+    start = clock()
+    deadline = start + timeout
+    with tracer.span(name, record=record):
+        while True:
+            value = condition()
+            if value:
+                break
+            now = clock()
+            if now >= deadline:
+                value = None
+                break
+            time.sleep(min(interval, deadline - now))
+
+    if replaces is not None and stats is not None:
+        waited = clock() - start
+        fixed = replaces(waited) if callable(replaces) else replaces
+        stats['wait_saved'] = stats.get('wait_saved', 0) + max(0, fixed - waited)
+    return value
+
+
+def stable_value(read, stable_for):
+    '''Condition that holds once read() has returned the same true value for stable_for seconds'''
+
+    state = {'value': None, 'since': None}
+
+    def condition():
+        value = read()
+        now = clock()
+        if not value or value != state['value']:
+            state['value'] = value
+            state['since'] = now
+            return None
+        return value if now - state['since'] >= stable_for else None
+
+    return condition
+
+
+def network_idle(remote, idle_for=0.5):
+    '''Condition that holds once the page has loaded and fetched no new resources for idle_for seconds'''
+
+    # + 1 so that a page without any resources counts as a value
+    return stable_value(lambda: remote.execute_script(RESOURCE_COUNT_SCRIPT) + 1, idle_for)
+
+
+def profile_unlocked(user_data_dir):
+    '''Condition that holds once no browser holds the lock of user_data_dir'''
+
+    return lambda: not any(os.path.lexists(os.path.join(user_data_dir, name)) for name in PROFILE_LOCK_FILES)